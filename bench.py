@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures the overhead of builder itself, using synthetic local git repos
+# with tiny projects, so it runs offline on any Linux box.
+
+import argparse, os
+import contextlib
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import builder
+
+KINDS = ('plain', 'meson', 'cmake', 'autotools')
+
+KIND_TOOLS = {
+    'plain': (),
+    'meson': ('meson', 'ninja'),
+    'cmake': ('cmake', 'ninja'),
+    'autotools': ('autoreconf', 'make'),
+}
+
+MAIN_C = 'int main(void) { return %d; }\n'
+
+MESON_BUILD = """project('%(name)s', 'c')
+executable('%(name)s', 'main.c', install : true)
+"""
+
+CMAKELISTS = """cmake_minimum_required(VERSION 3.5)
+project(%(name)s C)
+add_executable(%(name)s main.c)
+install(TARGETS %(name)s DESTINATION bin)
+"""
+
+CONFIGURE_AC = """AC_INIT([%(name)s], [1.0])
+AM_INIT_AUTOMAKE([foreign])
+AC_PROG_CC
+AC_CONFIG_FILES([Makefile])
+AC_OUTPUT
+"""
+
+MAKEFILE_AM = """bin_PROGRAMS = %(name)s
+%(name)s_SOURCES = main.c
+"""
+
+AUTOGEN_SH = """#!/bin/sh
+autoreconf -fi
+"""
+
+GITIGNORE_AUTOTOOLS = """/build*/
+Makefile.in
+aclocal.m4
+autom4te.cache/
+compile
+configure
+configure~
+depcomp
+install-sh
+missing
+m4/
+"""
+
+def available_kinds():
+    kinds = []
+    for kind in KINDS:
+        if all(shutil.which(tool) for tool in KIND_TOOLS[kind]):
+            kinds.append(kind)
+    return kinds
+
+def git(cwd, *args):
+    cmd = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost']
+    subprocess.run(cmd + list(args), cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def write(path, content, mode=None):
+    with open(path, 'w') as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+
+def make_project(path, name, kind):
+    os.makedirs(path)
+    values = {'name': name}
+
+    write(os.path.join(path, 'main.c'), MAIN_C % 0)
+    write(os.path.join(path, '.gitignore'), '/build*/\n')
+    if kind == 'meson':
+        write(os.path.join(path, 'meson.build'), MESON_BUILD % values)
+    elif kind == 'cmake':
+        write(os.path.join(path, 'CMakeLists.txt'), CMAKELISTS % values)
+    elif kind == 'autotools':
+        write(os.path.join(path, 'configure.ac'), CONFIGURE_AC % values)
+        write(os.path.join(path, 'Makefile.am'), MAKEFILE_AM % values)
+        write(os.path.join(path, 'autogen.sh'), AUTOGEN_SH, 0o755)
+        write(os.path.join(path, '.gitignore'), GITIGNORE_AUTOTOOLS)
+
+    git(path, 'init', '-q')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Initial commit')
+
+# Creates 'size' upstream repos and a pkglist.json using them, where each
+# package depends on up to two of the previous ones.
+def make_pkglist(topdir, size, kinds, seed=0):
+    rand = random.Random(seed)
+    upstream = os.path.join(topdir, 'upstream')
+
+    pkglist = {}
+    names = []
+    for i in range(size):
+        name = 'pkg%03d' % i
+        kind = kinds[i % len(kinds)]
+        make_project(os.path.join(upstream, name), name, kind)
+
+        pkg = {
+            'uri': 'file://' + os.path.join(upstream, name),
+            'deps': rand.sample(names, min(len(names), rand.randint(0, 2))),
+        }
+        if kind != 'plain':
+            pkg['buildsystem'] = kind
+        pkglist[name] = pkg
+        names.append(name)
+
+    pkglistpath = os.path.join(topdir, 'pkglist.json')
+    with open(pkglistpath, 'w') as f:
+        json.dump(pkglist, f, indent=4)
+    return pkglistpath, names
+
+def run_builder(*args):
+    saved_argv = sys.argv
+    sys.argv = ['builder.py'] + list(args)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                builder.main()
+    finally:
+        sys.argv = saved_argv
+
+def timed(results, size, step, *args, repeat=1):
+    times = []
+    error = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        try:
+            run_builder(*args)
+        except Exception as e:
+            error = str(e)
+            break
+        times.append(time.perf_counter() - start)
+
+    result = {'size': size, 'step': step}
+    if times:
+        times.sort()
+        result['seconds'] = times[len(times) // 2]
+        result['min'] = times[0]
+        result['repeat'] = len(times)
+    if error is not None:
+        result['error'] = error
+    results.append(result)
+
+    shown = '%.3fs' % result['seconds'] if times else 'FAILED: ' + error
+    print('%5d packages  %-12s %s' % (size, step, shown), flush=True)
+
+def bench_size(topdir, size, kinds, repeat):
+    results = []
+    pkglistpath, names = make_pkglist(topdir, size, kinds)
+
+    repo = 'bench%d' % size
+    repodir = os.path.join(topdir, 'repo')
+    os.makedirs(repodir)
+
+    timed(results, size, 'init', 'init', repo, repodir, '-f', pkglistpath)
+    timed(results, size, 'install', '-r', repo, 'install')
+    timed(results, size, 'noop', '-r', repo, 'install', repeat=repeat)
+
+    changed = names[len(names) // 2]
+    write(os.path.join(repodir, 'src', changed, 'main.c'), MAIN_C % 1)
+    timed(results, size, 'change', '-r', repo, 'install')
+
+    timed(results, size, 'clean', '-r', repo, 'clean')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the overhead of builder')
+    parser.add_argument('--sizes', default='10',
+            help='comma separated numbers of packages to test')
+    parser.add_argument('--kinds', default=None,
+            help='comma separated build systems of the packages, from %s '
+                 '(default: all available)' % ', '.join(KINDS))
+    parser.add_argument('--repeat', type=int, default=5,
+            help='times to repeat the no-op install')
+    parser.add_argument('--output', '-o', default='bench-results.jsonl',
+            help='file the results are appended to, as a JSON line')
+    parser.add_argument('--keep', action='store_true',
+            help='keep the temporary directory')
+    args = parser.parse_args()
+
+    if args.kinds is None:
+        kinds = available_kinds()
+    else:
+        kinds = args.kinds.split(',')
+        missing = [k for k in kinds if k not in available_kinds()]
+        if missing:
+            raise Exception('Build systems not available: ' + str(missing))
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    tmpdir = tempfile.mkdtemp(prefix='builder-bench-')
+    print('workdir:', tmpdir)
+    print('kinds:', ', '.join(kinds))
+
+    # builder keeps its list of repos in ~/.config, use a throwaway one
+    saved_home = os.environ.get('HOME')
+    os.environ['HOME'] = os.path.join(tmpdir, 'home')
+    results = []
+    try:
+        for size in sizes:
+            topdir = os.path.join(tmpdir, 'size%d' % size)
+            results += bench_size(topdir, size, kinds, args.repeat)
+    finally:
+        if saved_home is not None:
+            os.environ['HOME'] = saved_home
+        if not args.keep:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    record = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'kinds': kinds,
+        'results': results,
+    }
+    with open(args.output, 'a') as output:
+        output.write(json.dumps(record) + '\n')
+    print('results appended to', args.output)
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,33 @@
 # -*- coding: utf-8 -*-
 
 import argparse, os
+import collections
+import errno
+import contextlib
+import fcntl
+import functools
+import hashlib
 import os.path
+import re
+import select
 import shutil
 import shutil
+import stat
 import subprocess
+import sys
 import json
+import struct
+import termios
+import time
+import threading
 
-PKG_CMDS = ('install', 'clean')
+PKG_CMDS = ('install', 'resume', 'update', 'watch', 'uninstall', 'clean')
+REPO_CMDS = PKG_CMDS + ('env', 'stats')
+
+CLEAN_SCOPES = ('build', 'state', 'install', 'source')
+
+# Also in the 'builder' entry script
+ENV_CACHE_DIR = '~/.cache/builder/env'
 
 class Color:
     def __init__(self, msg, color):
@@ -41,25 +61,58 @@ class Gray(Color):
     def __init__(self, msg):
         Color.__init__(self, msg, '\033[90m')
 
+_print_lock = threading.Lock()
+# Line kept below everything else printed, while installing on a terminal
+_status_line = ''
+
+def status(*msg):
+    # Packages can be processed concurrently, so always print whole lines
+    line = ' '.join(str(m) for m in msg)
+    with _print_lock:
+        if _status_line:
+            sys.stdout.write('\r\033[K')
+        print(line, flush=True)
+        if _status_line:
+            sys.stdout.write(_status_line)
+            sys.stdout.flush()
+
+def set_status_line(line):
+    global _status_line
+    with _print_lock:
+        sys.stdout.write('\r\033[K' + line)
+        sys.stdout.flush()
+        _status_line = line
+
 class Logger:
     def __init__(self, logfile, verbose=False):
         self._logfilename = logfile
         self._logfile = open(logfile, 'w', buffering=1)
         self._verbose = verbose
+        self._lock = threading.Lock()
         print('logfile:', Gray(logfile))
 
     def log(self, msg, endl=False):
         if endl:
             msg = msg + '\n'
-        self._logfile.write(msg)
-        if self._verbose:
-            print(msg, end='')
+        with self._lock:
+            self._logfile.write(msg)
+            if self._verbose:
+                print(msg, end='')
     def logln(self, msg):
         self.log(msg, endl=True)
 
     def get_file(self):
         return self._logfile
 
+    @property
+    def verbose(self):
+        return self._verbose
+
+    def echo(self, output):
+        with _print_lock:
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+
 class RepoConfig:
     def __init__(self):
         default = '~/.config/builder.conf'
@@ -79,6 +132,82 @@ class RepoConfig:
     def use(self):
         return self._use
 
+    def jobserver_slots(self):
+        return self._config.get('jobserver_slots', os.cpu_count())
+
+    # Build root of the repo 'name', from its "build_root" in builder.conf or
+    # the global one, see parse_build_root()
+    def build_root(self, name, root=None):
+        if root is None:
+            conf = self._config['repos'].get(name, {})
+            root = conf.get('build_root', self._config.get('build_root'))
+        return parse_build_root(root)
+
+    # Memory builds can use in bytes, from a size like "16G" or a share of
+    # the RAM like "90%", or None if builds aren't limited
+    def memory_limit(self, limit=None):
+        if limit is None:
+            limit = self._config.get('memory_limit', '90%')
+        info = meminfo()
+        if info is None or str(limit).lower() in ('none', 'off', '0'):
+            return None
+        limit = str(limit).strip()
+        if limit.endswith('%'):
+            return int(info['MemTotal'] * float(limit[:-1]) / 100)
+        return parse_size(limit)
+
+    # Cache of installed packages shared by all repos, enabled with
+    # "artifacts": true or a dict overriding the defaults below
+    def artifacts(self, enable=None):
+        conf = self._config.get('artifacts', False)
+        if enable is None:
+            enable = conf is not False
+        if not enable:
+            return None
+
+        artifacts = {
+            'dir': '~/.cache/builder/artifacts',
+            'max_size': '10G',
+        }
+        if isinstance(conf, dict):
+            artifacts.update(conf)
+        return ArtifactCache(os.path.expanduser(artifacts['dir']),
+                             parse_size(artifacts['max_size']))
+
+    # Compiler cache shared by all repos, enabled with "ccache": true or a
+    # dict overriding the defaults below in builder.conf
+    def ccache(self, enable=None):
+        conf = self._config.get('ccache', False)
+        if enable is None:
+            enable = conf is not False
+        if not enable:
+            return None
+
+        ccache = {
+            'dir': '~/.cache/builder/ccache',
+            'max_size': '20G',
+        }
+        if isinstance(conf, dict):
+            ccache.update(conf)
+        ccache['dir'] = os.path.expanduser(ccache['dir'])
+        return ccache
+
+    # Mirrors of upstream repos shared by all repos, disabled with
+    # "mirrors": false or configured with a dict overriding the defaults below
+    def mirrors(self, enable=None):
+        conf = self._config.get('mirrors', True)
+        if enable is None:
+            enable = conf is not False
+        if not enable:
+            return None
+
+        mirrors = {
+            'dir': '~/.cache/builder/mirrors',
+        }
+        if isinstance(conf, dict):
+            mirrors.update(conf)
+        return GitMirrors(os.path.expanduser(mirrors['dir']))
+
     def _check_base_path(self, path):
         builderpath = os.path.join(path, '.builder')
         if os.path.isdir(builderpath):
@@ -112,6 +241,20 @@ class RepoConfig:
         if repo is not None:
             self._use = repo
 
+    # Files for the quick path of 'builder env', see the 'builder' script
+    def write_env_cache(self, name, content):
+        cachedir = os.path.expanduser(ENV_CACHE_DIR)
+        os.makedirs(cachedir, exist_ok=True)
+
+        repos = ''.join('%s\t%s\n' % (repo, conf['path'])
+                        for repo, conf in self._config['repos'].items())
+        for f, data in (('repos', repos), (name + '.sh', content)):
+            path = os.path.join(cachedir, f)
+            tmppath = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmppath, 'w') as cachefile:
+                cachefile.write(data)
+            os.replace(tmppath, path)
+
     def _update(self):
         os.makedirs(os.path.dirname(self._default_path), exist_ok=True)
         jsonfile = open(self._default_path, 'w')
@@ -130,12 +273,14 @@ class RepoConfig:
             default_path = self.get_path(default_repo)
         print('Repo in use: %s (%s)' % (default_repo, default_path))
 
-    def add(self, name, path):
+    def add(self, name, path, build_root=None):
         repos = self._config['repos']
         if name in repos:
             raise Exception('Repo %s already exists.' % name)
 
         repos[name] = { 'path': path }
+        if build_root is not None:
+            repos[name]['build_root'] = build_root
         self._update()
 
     def remove(self, name):
@@ -161,24 +306,1076 @@ class RepoConfig:
     def get_path(self, repo):
         return self._config['repos'][repo]['path']
 
+def _pkgconfig_names(text):
+    names = set()
+    for token in re.split(r'[\s,\[\]]+', text):
+        # Skip version constraints, shell variables and m4 quoting leftovers
+        if re.match(r'^[A-Za-z][\w.+-]*$', token):
+            names.add(token)
+    return names
+
+_MESON_DEP_RE = re.compile(r"dependency\(\s*'([^']+)'")
+_MESON_PC_RE = re.compile(r"\.generate\(")
+_MESON_PC_NAME_RE = re.compile(r"(filebase|name)\s*:\s*'([^']+)'")
+_AUTOTOOLS_DEP_RE = re.compile(
+        r'PKG_CHECK_MODULES\(\s*\[?\w+\]?\s*,\s*\[?([^\]\)]+)')
+_AUTOTOOLS_EXISTS_RE = re.compile(r'PKG_CHECK_EXISTS\(\s*\[?([^\]\),]+)')
+_CMAKE_DEP_RE = re.compile(r'pkg_check_modules\(\s*\w+([^\)]+)\)')
+
+# Returns the pkg-config modules a source tree provides and requires. This is
+# only a heuristic based on the build files, used for packages that don't
+# declare "deps" in pkglist.json.
+def scan_build_files(srcpath):
+    provides = set()
+    requires = set()
+
+    for root, dirs, files in os.walk(srcpath):
+        dirs[:] = [d for d in dirs
+                   if not d.startswith('.') and not d.startswith('build')]
+
+        for f in files:
+            if f.endswith('.pc.in'):
+                provides.add(f[:-len('.pc.in')])
+
+            if f not in ('meson.build', 'configure.ac', 'CMakeLists.txt'):
+                continue
+
+            with open(os.path.join(root, f), errors='replace') as buildfile:
+                content = buildfile.read()
+
+            if f == 'meson.build':
+                requires.update(_MESON_DEP_RE.findall(content))
+                for m in _MESON_PC_RE.finditer(content):
+                    args = content[m.end():m.end() + 500]
+                    names = dict(_MESON_PC_NAME_RE.findall(args))
+                    name = names.get('filebase', names.get('name'))
+                    if name:
+                        provides.add(name)
+            elif f == 'configure.ac':
+                for m in _AUTOTOOLS_DEP_RE.findall(content):
+                    requires.update(_pkgconfig_names(m))
+                for m in _AUTOTOOLS_EXISTS_RE.findall(content):
+                    requires.update(_pkgconfig_names(m))
+                if 'XORG_MACROS_VERSION' in content:
+                    requires.add('xorg-macros')
+            else:
+                for m in _CMAKE_DEP_RE.findall(content):
+                    requires.update(_pkgconfig_names(m))
+
+    requires.difference_update(('REQUIRED', 'QUIET', 'IMPORTED_TARGET'))
+    return provides, requires
+
+TOOLCHAIN_PROGS = ('cc', 'c++', 'gcc', 'g++', 'clang', 'ld', 'meson', 'ninja',
+                   'cmake', 'make', 'autoconf', 'automake', 'libtool')
+TOOLCHAIN_VARS = ('CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS')
+
+# Identifies the tools used to build packages without running them: a
+# different compiler binary or flags must trigger a rebuild.
+def toolchain_id(env):
+    ident = []
+    for prog in TOOLCHAIN_PROGS:
+        path = shutil.which(prog, path=env.get('PATH'))
+        if path is None:
+            continue
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        ident.append('%s:%s:%d:%d' % (prog, path, st.st_size, st.st_mtime_ns))
+    for var in TOOLCHAIN_VARS:
+        ident.append('%s=%s' % (var, env.get(var, '')))
+
+    return hashlib.sha1('\n'.join(ident).encode()).hexdigest()
+
+def parse_size(size):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = str(size).strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def format_size(size):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'T'
+    return '%.1f%s' % (size, unit)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % divmod(seconds, 60)
+    return '%dh%02dm' % divmod(seconds // 60, 60)
+
+# Whether two files have the same type, permissions and contents, without
+# following symlinks
+def same_file(a, b):
+    try:
+        sta = os.lstat(a)
+        stb = os.lstat(b)
+    except FileNotFoundError:
+        return False
+
+    if sta.st_mode != stb.st_mode:
+        return False
+    if stat.S_ISLNK(sta.st_mode):
+        return os.readlink(a) == os.readlink(b)
+    if not stat.S_ISREG(sta.st_mode) or sta.st_size != stb.st_size:
+        return False
+
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            chunk = fa.read(1024 * 1024)
+            if chunk != fb.read(1024 * 1024):
+                return False
+            if not chunk:
+                return True
+
+# Moves the files of 'src' into 'dst', each one atomically. Files already in
+# 'dst' with the same contents are left alone, keeping their timestamps so
+# nothing depending on them gets rebuilt. Returns the paths of all the files
+# relative to 'dst', and the set of those actually replaced.
+def merge_tree(src, dst):
+    files = []
+    updated = set()
+    for root, dirs, filenames in os.walk(src):
+        reldir = os.path.relpath(root, src)
+        dstdir = os.path.normpath(os.path.join(dst, reldir))
+        os.makedirs(dstdir, exist_ok=True)
+
+        # os.walk lists symlinks to dirs in 'dirs', move them as files
+        for d in list(dirs):
+            if os.path.islink(os.path.join(root, d)):
+                dirs.remove(d)
+                filenames.append(d)
+
+        for f in filenames:
+            relpath = os.path.normpath(os.path.join(reldir, f))
+            srcpath = os.path.join(root, f)
+            dstpath = os.path.join(dstdir, f)
+            files.append(relpath)
+            if same_file(srcpath, dstpath):
+                continue
+
+            if os.path.isdir(dstpath) and not os.path.islink(dstpath):
+                shutil.rmtree(dstpath)
+            os.replace(srcpath, dstpath)
+            updated.add(relpath)
+    return files, updated
+
+# Hash of an installed file, or of the target of a symlink
+def file_digest(path):
+    digest = hashlib.sha256()
+    if os.path.islink(path):
+        digest.update(b'symlink:' + os.fsencode(os.readlink(path)))
+        return digest.hexdigest()
+
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+_LIBRARY_RE = re.compile(r'\.(a|so(\.\d+)*)$')
+
+# Whether other packages can be built against an installed file: headers,
+# libraries and pkg-config files
+def interface_file(path):
+    return (path.startswith('include' + os.sep) or path.endswith('.pc') or
+            _LIBRARY_RE.search(path) is not None)
+
+# Removes 'path' and then its parent dirs that became empty, up to 'top'
+def remove_file(path, top):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+    parent = os.path.dirname(path)
+    while parent != top and parent.startswith(top + os.sep):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+# Moves 'path' out of the way at once, into 'trashdir' on the same file
+# system, and deletes it in a background process that outlives builder
+def remove_tree_async(path, trashdir):
+    import tempfile
+
+    os.makedirs(trashdir, exist_ok=True)
+    trash = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                             dir=trashdir)
+    try:
+        os.rename(path, os.path.join(trash, os.path.basename(path)))
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        os.rmdir(trash)
+        shutil.rmtree(path, ignore_errors=True)
+        return
+
+    empty_trash(trash)
+
+def empty_trash(path):
+    subprocess.Popen(['rm', '-rf', path], start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL)
+
+# Store of installed packages, addressed by a key identifying everything the
+# package was built from. Least recently used artifacts are evicted past
+# 'max_size'.
+class ArtifactCache:
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @staticmethod
+    def key(parts):
+        parts = json.dumps(parts, sort_keys=True)
+        return hashlib.sha256(parts.encode()).hexdigest()
+
+    def _tarpath(self, key):
+        return os.path.join(self._path, key + '.tar.gz')
+
+    def lookup(self, key):
+        tarpath = self._tarpath(key)
+        try:
+            # mtime is used as the last use time for eviction
+            os.utime(tarpath)
+        except FileNotFoundError:
+            return None
+        return tarpath
+
+    def extract(self, key, destdir):
+        import tarfile
+
+        with tarfile.open(self._tarpath(key)) as tar:
+            # Artifacts are created by us, they are trusted
+            if hasattr(tarfile, 'fully_trusted_filter'):
+                tar.extractall(destdir, filter='fully_trusted')
+            else:
+                tar.extractall(destdir)
+
+    def store(self, key, srcdir, meta):
+        import tarfile
+
+        os.makedirs(self._path, exist_ok=True)
+        tarpath = self._tarpath(key)
+        tmppath = '%s.%d.%d.tmp' % (tarpath, os.getpid(),
+                                    threading.get_ident())
+
+        with tarfile.open(tmppath, 'w:gz', compresslevel=1) as tar:
+            tar.add(srcdir, arcname='.')
+
+        meta = dict(meta)
+        meta['key'] = key
+        meta['created'] = time.time()
+        with open(tmppath + '.json', 'w') as metafile:
+            json.dump(meta, metafile, indent=4)
+        os.replace(tmppath + '.json', os.path.join(self._path, key + '.json'))
+        os.replace(tmppath, tarpath)
+
+        self.prune(self._max_size)
+
+    def entries(self):
+        entries = []
+        if not os.path.isdir(self._path):
+            return entries
+
+        for f in os.listdir(self._path):
+            if not f.endswith('.tar.gz'):
+                continue
+            key = f[:-len('.tar.gz')]
+            try:
+                st = os.stat(os.path.join(self._path, f))
+                with open(os.path.join(self._path, key + '.json')) as metafile:
+                    meta = json.load(metafile)
+            except (FileNotFoundError, ValueError):
+                meta = {'key': key}
+                st = None
+            if st is None:
+                continue
+            meta['size'] = st.st_size
+            meta['used'] = st.st_mtime
+            entries.append(meta)
+
+        entries.sort(key=lambda e: e['used'], reverse=True)
+        return entries
+
+    def remove(self, key):
+        for f in (self._tarpath(key), os.path.join(self._path, key + '.json')):
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+
+    def prune(self, max_size):
+        with self._lock:
+            removed = []
+            total = 0
+            for entry in self.entries():
+                total += entry['size']
+                if total > max_size:
+                    self.remove(entry['key'])
+                    removed.append(entry)
+            return removed
+
+# Bare mirrors of upstream repos, shared by all repos. Sources are cloned
+# with --shared from them, so each object is stored once on disk no matter
+# how many repos have a copy of the package.
+class GitMirrors:
+    def __init__(self, path):
+        self._path = path
+
+    def path(self, uri):
+        name = os.path.basename(uri.rstrip('/'))
+        if name.endswith('.git'):
+            name = name[:-4]
+        digest = hashlib.sha1(uri.encode()).hexdigest()[:12]
+        return os.path.join(self._path, '%s-%s.git' % (name, digest))
+
+    # Creates or updates the mirror of 'uri', running git through 'call',
+    # and returns its path. Other builder processes may be updating the
+    # same mirror, so this holds a lock on it.
+    def update(self, uri, call):
+        os.makedirs(self._path, exist_ok=True)
+        mirror = self.path(uri)
+
+        with open(mirror + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if os.path.isdir(mirror):
+                call(['git', 'fetch', '--prune', '--quiet'], cwd=mirror)
+                return mirror
+
+            tmppath = '%s.%d.%d.tmp' % (mirror, os.getpid(),
+                                        threading.get_ident())
+            shutil.rmtree(tmppath, ignore_errors=True)
+            call(['git', 'clone', '--mirror', '--quiet', uri, tmppath])
+            # Clones borrow objects from the mirror, so they must never be
+            # pruned, even after a force push upstream
+            call(['git', 'config', 'gc.pruneExpire', 'never'], cwd=tmppath)
+            call(['git', 'config', 'gc.reflogExpireUnreachable', 'never'],
+                 cwd=tmppath)
+            os.rename(tmppath, mirror)
+        return mirror
+
+# GNU make compatible jobserver shared by every package being built. It's a
+# FIFO holding one token per free slot: each running package holds one token
+# for its main process, and make (or ninja >= 1.13) takes more from the FIFO
+# for each extra job. When builder itself runs under a jobserver using a
+# FIFO, that one is joined instead.
+class Jobserver:
+    SAMPLE_INTERVAL = 0.5
+
+    def __init__(self, slots, env):
+        self._tmpdir = None
+        self._tokens = []
+        self._tokens_lock = threading.Lock()
+        # Packages being built, each holding the slot of its main process
+        self._builds = 0
+
+        inherited = re.search(r'--jobserver-auth=fifo:(\S+)',
+                              env.get('MAKEFLAGS', ''))
+        if inherited:
+            self._path = inherited.group(1)
+            self.slots = None
+        else:
+            import tempfile
+            self._tmpdir = tempfile.mkdtemp(prefix='builder-jobserver-')
+            self._path = os.path.join(self._tmpdir, 'fifo')
+            os.mkfifo(self._path)
+            self.slots = slots
+
+        self._fd = os.open(self._path, os.O_RDWR)
+        self._nonblock_fd = os.open(self._path, os.O_RDONLY | os.O_NONBLOCK)
+        if self.slots is not None:
+            os.write(self._fd, b'+' * slots)
+
+        self._samples = []
+        self._stop = threading.Event()
+        self._monitor = threading.Thread(target=self._sample, daemon=True)
+        self._monitor.start()
+
+    @property
+    def fds(self):
+        return (self._fd,)
+
+    # make < 4.4 only knows about file descriptors, ninja only about FIFOs
+    def makeflags(self, fifo=False):
+        if fifo:
+            auth = 'fifo:' + self._path
+        else:
+            auth = '%d,%d' % (self._fd, self._fd)
+        return ' -j --jobserver-auth=' + auth
+
+    def acquire(self):
+        while True:
+            try:
+                token = os.read(self._fd, 1)
+                break
+            except BlockingIOError:
+                # make shares this file description and may leave it
+                # non-blocking, wait for a token to show up instead
+                select.select([self._fd], [], [])
+        with self._tokens_lock:
+            self._tokens.append(token)
+
+    def acquire_build(self):
+        self.acquire()
+        with self._tokens_lock:
+            self._builds += 1
+
+    def release_build(self):
+        with self._tokens_lock:
+            self._builds -= 1
+        self.release()
+
+    # Slots for a ninja too old to use the jobserver, which keeps the -j it
+    # starts with until it's done. Returns how many were taken from the
+    # jobserver, to be released after it, and the -j to use: one more for
+    # the slot of the package, but at least an even share of all the slots
+    # among the packages being built. Otherwise a long build started while
+    # the others hold the slots would run with -j1 to the end, so this may
+    # run more jobs than there are slots for a while.
+    def fixed_jobs(self, limit):
+        extra = self.try_acquire(limit - 1)
+        with self._tokens_lock:
+            share = (self.slots or limit) // max(self._builds, 1)
+        return extra, max(extra + 1, min(share, limit))
+
+    def try_acquire(self, count):
+        acquired = 0
+        while acquired < count:
+            try:
+                token = os.read(self._nonblock_fd, 1)
+            except BlockingIOError:
+                break
+            with self._tokens_lock:
+                self._tokens.append(token)
+            acquired += 1
+        return acquired
+
+    def release(self, count=1):
+        with self._tokens_lock:
+            tokens = self._tokens[:count]
+            del self._tokens[:count]
+        os.write(self._fd, b''.join(tokens))
+
+    def _available(self):
+        buf = fcntl.ioctl(self._fd, termios.FIONREAD, struct.pack('i', 0))
+        return struct.unpack('i', buf)[0]
+
+    def _sample(self):
+        while not self._stop.wait(self.SAMPLE_INTERVAL):
+            if self.slots is not None:
+                self._samples.append(self.slots - self._available())
+
+    def close(self):
+        self._stop.set()
+        self._monitor.join()
+        os.close(self._nonblock_fd)
+        os.close(self._fd)
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def usage(self):
+        if not self._samples:
+            return None
+        samples = self._samples
+        average = float(sum(samples)) / len(samples)
+        full = 100.0 * samples.count(self.slots) / len(samples)
+        return average, max(samples), full
+
+# Sizes in /proc/meminfo, in bytes, or None where there isn't one
+def meminfo():
+    try:
+        with open('/proc/meminfo') as f:
+            lines = f.readlines()
+    except IOError:
+        return None
+
+    info = {}
+    for line in lines:
+        key, value = line.split(':', 1)
+        info[key] = int(value.split()[0]) * 1024
+    return info
+
+# Keeps the memory used by the whole machine under 'limit' bytes. Packages
+# only start when their historical peak fits, and while memory is short the
+# jobserver slots freed by builds are held back, lowering the parallelism of
+# every make and ninja sharing them.
+class MemoryGovernor:
+    SAMPLE_INTERVAL = 0.5
+
+    def __init__(self, limit, jobserver):
+        self.limit = limit
+        self._margin = limit // 20
+        self._jobserver = jobserver
+        self._cond = threading.Condition()
+        self._reserved = {}
+        # For each running package: the memory used when it started, how
+        # much of their reservations the packages running then had taken,
+        # and the most memory it took itself since
+        self._baselines = {}
+        self._taken = {}
+        self._growths = {}
+        self._withheld = 0
+
+        self.used = self._used()
+        self.peak = self.used
+        self.max_withheld = 0
+        self.delayed = 0
+
+        self._stop = threading.Event()
+        self._monitor = threading.Thread(target=self._sample, daemon=True)
+        self._monitor.start()
+
+    @staticmethod
+    def _used():
+        info = meminfo()
+        return info['MemTotal'] - info['MemAvailable']
+
+    def _sample(self):
+        while not self._stop.wait(self.SAMPLE_INTERVAL):
+            used = self._used()
+            self._update(used)
+            self._throttle(used)
+
+    def _update(self, used):
+        with self._cond:
+            self.used = used
+            self.peak = max(self.peak, used)
+            for key in self._growths:
+                self._growths[key] = max(self._growths[key],
+                                         self._growth(key, used))
+            self._cond.notify_all()
+
+    # How much the memory used grew since 'key' started, less what the
+    # other packages being built are expected to add to what they had
+    # taken by then
+    def _growth(self, key, used):
+        taken = self._taken[key]
+        others = sum(expected - taken.get(other, 0)
+                     for other, expected in self._reserved.items()
+                     if other != key)
+        return used - self._baselines[key] - others
+
+    def _throttle(self, used):
+        slots = self._jobserver.slots
+        if slots is None:
+            # The slots belong to a parent make, leave them alone
+            return
+
+        if used > self.limit - self._margin:
+            # The last slot is never held, so builds keep making progress
+            if self._withheld < slots - 1:
+                self._withheld += self._jobserver.try_acquire(1)
+                self.max_withheld = max(self.max_withheld, self._withheld)
+        elif used < self.limit - 2 * self._margin and self._withheld:
+            self._jobserver.release(1)
+            self._withheld -= 1
+
+    # Waits until a package expected to use 'expected' bytes at its peak
+    # fits under the limit, which is always the case when nothing else is
+    # being built. Packages which just started don't show up in the used
+    # memory yet, so their expected peak counts instead.
+    def admit(self, key, expected):
+        with self._cond:
+            waited = False
+            while self._reserved:
+                reserved = sum(self._reserved.values())
+                if max(self.used, reserved) + expected <= self.limit:
+                    break
+                waited = True
+                self._cond.wait()
+            if waited:
+                self.delayed += 1
+            self._taken[key] = dict(
+                (other, min(reserved, max(self.used - self._baselines[other],
+                                          0)))
+                for other, reserved in self._reserved.items())
+            self._reserved[key] = expected
+            self._baselines[key] = self.used
+            self._growths[key] = 0
+
+    # Returns how much memory the package took at most, in bytes. The
+    # packages built at the same time are assumed to take what they were
+    # expected to, so it's only exact for those built alone.
+    def done(self, key):
+        with self._cond:
+            del self._reserved[key]
+            del self._baselines[key]
+            del self._taken[key]
+            growth = self._growths.pop(key)
+            self._cond.notify_all()
+        return growth
+
+    def close(self):
+        self._stop.set()
+        self._monitor.join()
+        if self._withheld:
+            self._jobserver.release(self._withheld)
+            self._withheld = 0
+
+# Watches source trees for changes with inotify, through ctypes. Each tree
+# is identified by a tag, returned when something changes under it.
+class Inotify:
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+
+    MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE)
+    EVENT = struct.Struct('iIII')
+
+    # Temporary files of editors
+    IGNORED_RE = re.compile(r'(^\.#|~$|\.sw[a-p]$|^4913$)')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errnum = ctypes.get_errno()
+            raise OSError(errnum, 'inotify_init1: ' + os.strerror(errnum))
+
+        self._watches = {}
+        self._skip = {}
+
+    def add_tree(self, path, tag, skip=()):
+        self._skip[tag] = set(skip)
+        self._add_tree(path, tag)
+
+    def _add_tree(self, path, tag):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if d != '.git' and
+                       os.path.join(root, d) not in self._skip[tag]]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root),
+                                              self.MASK)
+            if wd < 0:
+                errnum = self._ctypes.get_errno()
+                if errnum == errno.ENOENT:
+                    continue
+                if errnum == errno.ENOSPC:
+                    raise OSError(errnum, 'Out of inotify watches, raise '
+                                  'fs.inotify.max_user_watches')
+                raise OSError(errnum, 'inotify_add_watch %s: %s' %
+                              (root, os.strerror(errnum)))
+            self._watches[wd] = (root, tag)
+
+    # Returns the tags of the trees that changed, waiting up to 'timeout'
+    # seconds for a change, or forever if None
+    def wait(self, timeout=None):
+        tags = set()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        while ready:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    # Events were lost, anything may have changed
+                    tags.update(t for _, t in self._watches.values())
+                    continue
+                if wd not in self._watches:
+                    continue
+                root, tag = self._watches[wd]
+                name = os.fsdecode(name)
+                if self.IGNORED_RE.search(name):
+                    continue
+
+                path = os.path.join(root, name)
+                if path in self._skip[tag]:
+                    continue
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE |
+                                                    self.IN_MOVED_TO):
+                    self._add_tree(path, tag)
+                tags.add(tag)
+            ready, _, _ = select.select([self._fd], [], [], 0)
+        return tags
+
+    def close(self):
+        os.close(self._fd)
+
+# Fallback for Inotify, finding changes by comparing the state of the
+# sources from git every POLL_INTERVAL seconds
+class SourcePoller:
+    POLL_INTERVAL = 2.0
+
+    def __init__(self, env):
+        self._env = env
+        self._trees = {}
+
+    def add_tree(self, path, tag, skip=()):
+        self._trees[tag] = (path, None)
+        self._poll()
+
+    def _poll(self):
+        tags = set()
+        statuses = [(tag, path, start_source_state(path, self._env))
+                    for tag, (path, state) in self._trees.items()]
+        for tag, path, gitstatus in statuses:
+            head, dirty, clean = finish_source_state(gitstatus)
+            if self._trees[tag][1] != (head, dirty):
+                tags.add(tag)
+            self._trees[tag] = (path, (head, dirty))
+        return tags
+
+    def wait(self, timeout=None):
+        while True:
+            time.sleep(self.POLL_INTERVAL if timeout is None else timeout)
+            tags = self._poll()
+            if tags or timeout is not None:
+                return tags
+
+    def close(self):
+        pass
+
+def ninja_version(env):
+    try:
+        result = subprocess.run(['ninja', '--version'], env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True)
+    except FileNotFoundError:
+        return None
+    try:
+        return tuple(int(v) for v in result.stdout.strip().split('.')[:2])
+    except ValueError:
+        return None
+
+# Returns the (hits, misses) counters of the compiler cache, if in use
+def ccache_stats(env):
+    ccache = env.get('BUILDER_CCACHE')
+    if ccache is None:
+        return None
+
+    result = subprocess.run([ccache, '--print-stats'], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        return None
+
+    stats = {}
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].isdigit():
+            stats[fields[0]] = int(fields[1])
+
+    # Counter names changed between ccache 3 and 4
+    hits = (stats.get('direct_cache_hit', stats.get('cache_hit_direct', 0)) +
+            stats.get('preprocessed_cache_hit',
+                      stats.get('cache_hit_preprocessed', 0)))
+    misses = stats.get('cache_miss', 0)
+    return hits, misses
+
+# Returns the slowest targets built by ninja, as (seconds, target), from the
+# entries added to .ninja_log after 'offset'.
+def slowest_ninja_targets(ninja_log, offset=0, count=10):
+    targets = {}
+    try:
+        with open(ninja_log, errors='replace') as logfile:
+            logfile.seek(offset)
+            for line in logfile:
+                # start, end, mtime, target, command hash
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 5 or line.startswith('#'):
+                    continue
+                duration = (int(fields[1]) - int(fields[0])) / 1000.0
+                targets[fields[3]] = duration
+    except (FileNotFoundError, ValueError):
+        return []
+
+    slowest = sorted(((d, t) for t, d in targets.items()), reverse=True)
+    return slowest[:count]
+
+BUILDTYPES = ('debug', 'debugoptimized', 'release')
+
+def pkg_variant(build32=False):
+    return '32' if build32 else '64'
+
+# Name of a package in messages, telling the 32 bits builds apart
+def pkg_label(name, build32=False):
+    return name + ' [32]' if build32 else name
+
+# Parses variants like '64:debugoptimized,32:debug' into (build32, buildtype)
+# pairs. The buildtype is optional, defaulting to the build system's own.
+def parse_variants(spec):
+    variants = []
+    for v in spec.split(','):
+        arch, _, buildtype = v.strip().partition(':')
+        if arch not in ('64', '32'):
+            raise Exception('Invalid variant %s, must be 64 or 32 with an '
+                            'optional :buildtype' % v)
+        if buildtype and buildtype not in BUILDTYPES:
+            raise Exception('Invalid buildtype %s, must be one of: %s' %
+                            (buildtype, ', '.join(BUILDTYPES)))
+        build32 = arch == '32'
+        # Both would install the same files into the prefix
+        if any(b == build32 for b, _ in variants):
+            raise Exception('Only one variant per architecture is possible, '
+                            'got %s' % spec)
+        variants.append((build32, buildtype or None))
+    return variants
+
+def pkg_buildpath(srcpath, build32=False):
+    return os.path.join(srcpath, 'build32' if build32 else 'build')
+
+# Build system of a package: its "buildsystem" from pkglist.json, or else
+# the first one found in its sources, or None if there is none
+def pkg_buildsystem(pkgconf, srcpath):
+    if pkgconf.get('buildsystem') is not None:
+        return pkgconf['buildsystem']
+    for buildsystem, f in (('meson', 'meson.build'),
+                           ('autotools', 'autogen.sh'),
+                           ('cmake', 'CMakeLists.txt')):
+        if os.path.exists(os.path.join(srcpath, f)):
+            return buildsystem
+    return None
+
+# A "build_root" setting as a dict with the 'path' build dirs go under and
+# the 'min_free' space needed there to start a new one, or None if build
+# dirs stay next to the sources
+def parse_build_root(root):
+    if root is None or root is False or str(root).lower() == 'none':
+        return None
+    build_root = {
+        'min_free': '2G',
+    }
+    if isinstance(root, dict):
+        build_root.update(root)
+    else:
+        build_root['path'] = root
+    build_root['path'] = os.path.abspath(os.path.expanduser(build_root['path']))
+    build_root['min_free'] = parse_size(build_root['min_free'])
+    return build_root
+
+# Where a package is meant to be built: under its "build_root" from
+# pkglist.json if it has one, else under the repo's 'build_root'. Several
+# repos can share a build root, so each gets its own dir in it.
+def desired_buildpath(pkgconf, srcpath, basedir, build32, build_root):
+    if 'build_root' in pkgconf:
+        build_root = parse_build_root(pkgconf['build_root'])
+    if build_root is None:
+        return pkg_buildpath(srcpath, build32), None
+
+    repodir = '%s-%s' % (os.path.basename(basedir),
+                         hashlib.sha1(basedir.encode()).hexdigest()[:8])
+    pkgdir = os.path.join(build_root['path'], repodir,
+                          os.path.basename(srcpath))
+    return pkg_buildpath(pkgdir, build32), build_root
+
+# Build dirs under a build root are trashed in it, to stay on its file system
+def build_root_trash(root):
+    return os.path.join(root, '.trash')
+
+# Space available to unprivileged users in the filesystem of 'path', which
+# may not exist yet
+def free_space(path):
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def _digest(values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+def _pkg_config(pkgconf):
+    return {
+        'meson': pkgconf.get('meson'),
+        'autotools': pkgconf.get('autotools'),
+        'cmake': pkgconf.get('cmake'),
+    }
+
+# Everything from pkglist.json and the command line affecting a build
+def options_digest(pkgconf, build32, buildtype):
+    return _digest({
+        'config': _pkg_config(pkgconf),
+        'buildsystem': pkgconf.get('buildsystem'),
+        'skipinstall': pkgconf.get('skipinstall', False),
+        'build32': build32,
+        'buildtype': buildtype,
+    })
+
+# Everything affecting how a package is configured
+def configure_digest(pkgconf, build32, buildtype, prefix, ccache):
+    return _digest({
+        'ccache': ccache,
+        'config': _pkg_config(pkgconf),
+        'build32': build32,
+        'buildtype': buildtype,
+        'prefix': prefix,
+    })
+
+# Packages whose files 'name' is built against, so their fingerprints are
+# part of its artifact key: its dependencies in 'graph' and those declared
+# in 'pkglist'. Those skipping install put nothing in the prefix, and are
+# never recorded as installed either.
+def artifact_deps(name, graph, pkglist):
+    deps = list(graph[name])
+    for dep in pkglist[name].get('deps', []):
+        if dep not in deps:
+            deps.append(dep)
+    return [dep for dep in deps
+            if not pkglist.get(dep, {}).get('skipinstall', False)]
+
+# Returns the HEAD of a source tree, a digest of its uncommitted changes and
+# whether it has none, all from a single 'git status'.
+def source_state(srcpath, env):
+    return finish_source_state(start_source_state(srcpath, env))
+
+def start_source_state(srcpath, env):
+    cmd = ['git', 'status', '--porcelain=v2', '--branch', '-z',
+           '--untracked-files=normal', '--', '.']
+    for build32 in (False, True):
+        rel = os.path.relpath(pkg_buildpath(srcpath, build32), srcpath)
+        if not rel.startswith('..'):
+            cmd.append(':(exclude)' + rel)
+
+    gitstatus = subprocess.Popen(cmd, cwd=srcpath, env=env,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+    gitstatus.srcpath = srcpath
+    return gitstatus
+
+def finish_source_state(gitstatus):
+    srcpath = gitstatus.srcpath
+    output = gitstatus.communicate()[0]
+    if gitstatus.returncode != 0:
+        raise Exception('Failed to get git status of ' + srcpath)
+
+    head = None
+    clean = True
+    dirty = hashlib.sha1()
+    entries = iter(output.decode(errors='replace').split('\0'))
+    for entry in entries:
+        if entry.startswith('# branch.oid '):
+            head = entry[len('# branch.oid '):]
+            continue
+        if not entry or entry.startswith('#'):
+            continue
+
+        if entry[0] == '1':
+            path = entry.split(' ', 8)[8]
+        elif entry[0] == '2':
+            path = entry.split(' ', 9)[9]
+            # renames are followed by the original path
+            next(entries, None)
+        elif entry[0] == 'u':
+            path = entry.split(' ', 10)[10]
+        else:
+            path = entry[2:]
+
+        clean = False
+        dirty.update(entry.encode())
+        try:
+            st = os.lstat(os.path.join(srcpath, path))
+            dirty.update(b'%d:%d' % (st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+
+    return head, dirty.hexdigest(), clean
+
+_source_locks = collections.defaultdict(threading.Lock)
+_source_locks_lock = threading.Lock()
+
+# Lock for the changes builder makes to a source tree, shared by the
+# variants of a package being built at the same time
+def source_lock(srcpath):
+    with _source_locks_lock:
+        return _source_locks[srcpath]
+
+_ERROR_LINE_RE = re.compile(r'error|FAILED|fatal', re.IGNORECASE)
+
 class Pkg:
+    CHUNK_SIZE = 64 * 1024
+    TAIL_SIZE = 64 * 1024
+    FAILURE_LINES = 20
+    FAILURE_ERROR_LINES = 5
+
+    # What meson's buildtypes mean for the other build systems
+    CMAKE_BUILDTYPES = {
+        'debug': 'Debug',
+        'debugoptimized': 'RelWithDebInfo',
+        'release': 'Release',
+    }
+    AUTOTOOLS_BUILDTYPE_FLAGS = {
+        'debug': '-O0 -g',
+        'debugoptimized': '-O2 -g',
+        'release': '-O3',
+    }
+
     def __init__(self, pkglist, name, basedir, logger, env,
-                 build32=False, buildtype='debug'):
+                 build32=False, buildtype='debug', toolchain=None,
+                 artifacts=None, jobserver=None, db=None, mirrors=None,
+                 progress=None, build_root=None):
         self.name = name
+        self._progress = progress
+        self._db = db
+        self._artifacts = artifacts
+        self._mirrors = mirrors
+        self._jobserver = jobserver
         self._logger = logger
         self._env = env
         self._pkglist = pkglist
         self._build32 = build32
         self._buildtype = buildtype
-
-        confdir = os.path.join(basedir, '.builder/pkgs')
-        self.jsonpath = os.path.join(confdir, name + '.json')
-        if os.path.exists(self.jsonpath):
-            self._load_from(self.jsonpath)
+        self._toolchain = toolchain
+        self._fingerprint = None
+        self._updated_files = None
+        self.changed_files = set()
+        # The phase being run, or the one that failed, and what was done
+        # with the package: 'built', 'cached' or 'skipped'
+        self.phase = None
+        self.outcome = None
+
+        self.variant = pkg_variant(build32)
+        self.label = pkg_label(name, build32)
+        state = self._db.load_state(name, self.variant)
+        if state is not None:
+            self._load_from(state)
         else:
             self._create_new(basedir)
 
         self._inst_dir = os.path.join(basedir, 'usr')
+        self._stage_dir = os.path.join(basedir, '.builder/stage',
+                                       self.variant, name)
+        self._trash_dir = os.path.join(basedir, '.builder/trash')
+        self._logdir = os.path.join(basedir, '.builder/logs', name)
+        if build32:
+            self._logdir = os.path.join(self._logdir, self.variant)
+        self._logs = set()
+        self.timings = []
+        self.ninja_targets = []
 
         pkgconf = self._pkglist[self.name]
         self._skipinstall = pkgconf.get('skipinstall', False)
@@ -189,16 +1386,11 @@ class Pkg:
             'cmake': pkgconf.get('cmake'),
         }
 
-        self._buildsystem = pkgconf.get('buildsystem')
-
         srcdir = os.path.join(basedir, 'src')
         workdir = os.path.join(basedir, '.workdir')
 
         self.srcpath = os.path.join(srcdir, self.name)
-        if self._build32:
-            self.buildpath = os.path.join(self.srcpath, 'build32')
-        else:
-            self.buildpath = os.path.join(self.srcpath, 'build')
+        self.buildpath = self._choose_buildpath(basedir, build_root)
 
         self._skipped = True
 
@@ -206,104 +1398,411 @@ class Pkg:
         self._logger.logln('Creating new config for: %s' % self.name)
 
         self._configured = False
+        self._configured_digest = None
+        self._autogen_digest = None
         self._built = False
+        self._built_fingerprint = None
+        self._installed = False
+        self._artifact_key = None
+        self._configured_buildpath = None
+        self._configured_root = None
 
         self.update()
 
-    def _load_from(self, jsonpath):
-        jsonfile = open(jsonpath)
-        pkg = json.load(jsonfile)
-
+    def _load_from(self, state):
         self._logger.logln('Loading config for: %s' % self.name)
-        self._logger.logln(str(pkg))
-
-        if not '__builder__' in pkg:
-            raise Exception('%s is not a "Pkg" config file' % jsonpath)
-
-        self._configured = pkg['state']['configured']
-        self._built = pkg['state']['built']
+        self._logger.logln(str(state))
+
+        self._configured = state['configured']
+        self._configured_digest = state['configure_options']
+        self._autogen_digest = state['autogen']
+        self._built = state['built']
+        self._built_fingerprint = state['fingerprint']
+        self._installed = state['installed']
+        self._artifact_key = state['artifact']
+        self._configured_buildpath = state['buildpath']
+        self._configured_root = state['build_root']
 
     def get_conf(self, conftype):
         return self._config.get(conftype)
 
-    def _to_json(self):
-        json_dict = {
-            '__builder__': True,
-            'name': self.name,
-            'state': {
-                'configured': self._configured,
-                'built': self._built,
-            },
+    def _state(self):
+        return {
+            'configured': self._configured,
+            'configure_options': self._configured_digest,
+            'autogen': self._autogen_digest,
+            'built': self._built,
+            'fingerprint': self._built_fingerprint,
+            'installed': self._installed,
+            'artifact': self._artifact_key,
+            'buildpath': self._configured_buildpath,
+            'build_root': self._configured_root,
         }
 
-        return json_dict
-
     def update(self):
-        jsonfile = open(self.jsonpath, 'w')
-        json.dump(self, jsonfile, indent=4, default=Pkg._to_json)
-        jsonfile.close()
+        self._db.save_state(self.name, self.variant, self._state())
 
     @property
     def built(self):
         return self._built
 
+    @property
+    def build32(self):
+        return self._build32
+
+    @property
+    def built_fingerprint(self):
+        return self._built_fingerprint
+
     @built.setter
     def built(self, val):
         self._built = val
+        self._built_fingerprint = self.fingerprint() if val else None
+        # Whatever was just built still has to be installed
+        self._installed = False
+        self.update()
+        if val:
+            self._skipped = False
+
+    @property
+    def installed(self):
+        return self._installed
+
+    @installed.setter
+    def installed(self, val):
+        self._installed = val
         self.update()
         if val:
             self._skipped = False
 
+    # Build dirs stay where they were configured, unless the build root
+    # changed since or they were wiped with it. New ones go next to the
+    # sources when the build root is short of space.
+    def _choose_buildpath(self, basedir, build_root):
+        intree = pkg_buildpath(self.srcpath, self._build32)
+        desired, build_root = desired_buildpath(self._pkglist[self.name],
+                                                self.srcpath, basedir,
+                                                self._build32, build_root)
+        self._root = build_root['path'] if build_root is not None else None
+
+        configured = self._configured_buildpath
+        if configured is None and self._configured:
+            # Configured before build dirs could move
+            configured = self._configured_buildpath = intree
+        if configured is not None and os.path.isdir(configured):
+            if self._configured_root == self._root:
+                return configured
+            if configured == desired:
+                # Where the new build root puts it anyway
+                self._configured_root = self._root
+                self.update()
+                return configured
+
+        if build_root is not None:
+            free = free_space(build_root['path'])
+            if free < build_root['min_free']:
+                self._logger.logln('Only %s free in %s, building %s next to '
+                                   'its sources' % (format_size(free),
+                                                    build_root['path'],
+                                                    self.label))
+                return intree
+        return desired
+
+    def _options_digest(self):
+        return options_digest(self._pkglist[self.name], self._build32,
+                              self._buildtype)
+
+    # The fingerprint changes whenever the sources (committed or not), build
+    # options or toolchain change, and is computed once per run.
+    def fingerprint(self):
+        if self._fingerprint is not None:
+            return self._fingerprint
+
+        head, dirty, self._clean = source_state(self.srcpath, self._env)
+        self._fingerprint = {
+            'head': head,
+            'dirty': dirty,
+            'options': self._options_digest(),
+            'toolchain': self._toolchain,
+        }
+        return self._fingerprint
+
     def __str__(self):
         return self.name
 
-    def _call(self, cmd, cwd=None, env=None):
+    def _phase_log(self, phase):
+        os.makedirs(self._logdir, exist_ok=True)
+        logpath = os.path.join(self._logdir, phase + '.log')
+        # Logs are overwritten by the first command of each phase in a run
+        mode = 'ab' if phase in self._logs else 'wb'
+        self._logs.add(phase)
+        return logpath, mode
+
+    # Output of commands goes straight to the log of the package and phase,
+    # in binary and large blocks. Only the last TAIL_SIZE bytes are kept in
+    # memory, to show them if the command fails.
+    def _call(self, cmd, cwd=None, env=None, pass_fds=(), phase='build'):
         if env is None:
             env = self._env
 
         if type(cmd) != type([]) or len(cmd) == 0:
             raise Exception('Invalid command to _call', cmd)
 
+        self.phase = phase
+        logpath, mode = self._phase_log(phase)
         self._logger.logln(' '.join(cmd))
-        cmdprocess = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT, universal_newlines=True,
-                cwd=cwd, env=env)
-        for line in cmdprocess.stdout:
-            self._logger.log(line)
-        result = cmdprocess.wait()
+        self._logger.logln('  output in ' + logpath)
+
+        progress = self._progress
+        if progress is not None:
+            progress.phase(self.label, phase)
+        steps = progress is not None and cmd[0] == 'ninja'
+
+        tail = collections.deque()
+        tailsize = 0
+        with open(logpath, mode, buffering=self.CHUNK_SIZE) as logfile:
+            logfile.write(b'$ ' + ' '.join(cmd).encode() + b'\n')
+
+            start = time.monotonic()
+            cmdprocess = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, bufsize=0,
+                    cwd=cwd, env=env, pass_fds=pass_fds)
+            fd = cmdprocess.stdout.fileno()
+            while True:
+                chunk = os.read(fd, self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                logfile.write(chunk)
+
+                tail.append(chunk)
+                tailsize += len(chunk)
+                while tailsize - len(tail[0]) >= self.TAIL_SIZE:
+                    tailsize -= len(tail.popleft())
+
+                if steps:
+                    progress.output(self.label, chunk)
+
+                if self._logger.verbose:
+                    self._logger.echo(chunk)
+
+            cmdprocess.stdout.close()
+            # wait4() instead of wait() to get the resources used by the
+            # command and all its children
+            _, waitstatus, rusage = os.wait4(cmdprocess.pid, 0)
+            result = os.waitstatus_to_exitcode(waitstatus)
+            cmdprocess.returncode = result
+
+        self.timings.append({
+            'phase': phase,
+            'wall': time.monotonic() - start,
+            'cpu': rusage.ru_utime + rusage.ru_stime,
+            'maxrss': rusage.ru_maxrss,
+        })
 
         if result != 0:
+            self._print_failure(cmd, b''.join(tail), logpath)
             raise Exception('Command failed', cmd, result)
 
-    def _fetch(self):
-        print('Fetching %s: ' % self.name, end='', flush=True)
+    def _print_failure(self, cmd, tail, logpath):
+        lines = tail.decode(errors='replace').splitlines()
+        shown = lines[-self.FAILURE_LINES:]
+
+        # Errors tend to be followed by a lot of noise, show the last ones
+        # even when they are not in the last lines
+        errors = [l for l in lines[:-self.FAILURE_LINES]
+                  if _ERROR_LINE_RE.search(l)]
+        errors = errors[-self.FAILURE_ERROR_LINES:]
+
+        msg = [str(Red('%s failed: %s' % (self.label, ' '.join(cmd))))]
+        msg += errors
+        if errors:
+            msg.append('...')
+        msg += shown
+        msg.append(str(Gray('full log: ' + logpath)))
+        status('\n'.join(msg))
+
+    def fetch(self):
+        self._logger.logln('')
+        self._logger.logln('Fetching package: ' + self.name)
 
         if os.path.exists(self.srcpath) and os.path.isdir(self.srcpath):
-            print(Gray('SKIP'))
+            status('Fetching %s:' % self.name, Gray('SKIP'))
             return
-        cmd = ['git', 'clone', self._pkglist[self.name]['uri'], self.srcpath]
-        self._call(cmd)
-        print(Green('DONE'))
+
+        uri = self._pkglist[self.name]['uri']
+        clone = self._pkglist[self.name].get('clone', {})
+        depth = clone.get('depth')
+        partial = clone.get('filter')
+
+        mirror = self._update_mirror()
+        if mirror is not None:
+            self._call(['git', 'clone', '--shared', mirror, self.srcpath],
+                       phase='fetch')
+            self._call(['git', 'remote', 'set-url', 'origin', uri],
+                       self.srcpath, phase='fetch')
+        else:
+            cmd = ['git', 'clone']
+            if depth is not None:
+                cmd += ['--depth', str(depth)]
+            if partial is not None:
+                cmd += ['--filter', partial]
+            self._call(cmd + [uri, self.srcpath], phase='fetch')
+        status('Fetching %s:' % self.name, Green('DONE'))
+
+    # Creates or updates the mirror of the package and returns its path, or
+    # None if the package doesn't use one
+    def _update_mirror(self):
+        if self._mirrors is None:
+            return None
+
+        clone = self._pkglist[self.name].get('clone', {})
+        # Shallow and partial clones are for not keeping the whole history
+        # around, which a mirror would do
+        shallow = 'depth' in clone or 'filter' in clone
+        if not clone.get('mirror', not shallow):
+            return None
+
+        def call(cmd, cwd=None):
+            self._call(cmd, cwd, phase='fetch')
+        return self._mirrors.update(self._pkglist[self.name]['uri'], call)
+
+    def _git_rev(self, rev):
+        cmd = ['git', 'rev-parse', '--verify', '--quiet', rev]
+        result = subprocess.run(cmd, cwd=self.srcpath, env=self._env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            return None
+        return result.stdout.decode().strip()
+
+    # Fetches new commits and fast-forwards the checkout to its upstream
+    # branch. Returns whether HEAD moved.
+    def pull(self):
+        self._logger.logln('')
+        self._logger.logln('Updating package: ' + self.name)
+
+        if not os.path.isdir(self.srcpath):
+            self.fetch()
+            return True
+
+        before = self._git_rev('HEAD')
+
+        mirror = self._update_mirror()
+        if mirror is not None:
+            cmd = ['git', 'fetch', '--tags', mirror,
+                   '+refs/heads/*:refs/remotes/origin/*']
+        else:
+            cmd = ['git', 'fetch', 'origin']
+            depth = self._pkglist[self.name].get('clone', {}).get('depth')
+            if depth is not None:
+                cmd += ['--depth', str(depth)]
+        self._call(cmd, self.srcpath, phase='fetch')
+
+        upstream = self._git_rev('@{upstream}')
+        if upstream is None:
+            self._logger.logln('%s has no upstream branch, not updating it' %
+                               self.name)
+            status('Updating %s:' % self.name, Yellow('NO UPSTREAM'))
+            return False
+        if upstream == before:
+            status('Updating %s:' % self.name, Gray('SKIP'))
+            return False
+
+        cmd = ['git', 'merge', '--ff-only', '--quiet', '@{upstream}']
+        self._call(cmd, self.srcpath, phase='fetch')
+        status('Updating %s:' % self.name,
+               Green('%s..%s' % (before[:10], upstream[:10])))
+        return True
+
+    def _ccache(self):
+        return self._env.get('BUILDER_CCACHE')
+
+    def _configure_digest(self):
+        return configure_digest(self._pkglist[self.name], self._build32,
+                                self._buildtype, self._inst_dir,
+                                self._ccache() is not None)
+
+    def _set_configured(self):
+        old = self._configured_buildpath
+        if old is not None and old != self.buildpath and os.path.isdir(old):
+            self._logger.logln('Build dir of %s moved from %s' %
+                               (self.label, old))
+            remove_tree_async(old, self._trash_for(old, self._trash_dir))
+
+        self._configured = True
+        self._configured_digest = self._configure_digest()
+        self._configured_buildpath = self.buildpath
+        self._configured_root = self._root
+        self.built = False
+
+    # Trash dir on the file system of 'path', the one of the build root it
+    # is in or else 'trashdir'
+    def _trash_for(self, path, trashdir):
+        for root in (self._root, self._configured_root):
+            if root is not None and path.startswith(root + os.sep):
+                return build_root_trash(root)
+        return trashdir
 
     def _check_configured(self):
-        if os.path.exists(self.buildpath) and os.path.isdir(self.buildpath):
+        if (os.path.isdir(self.buildpath) and
+                self._configured_buildpath == self.buildpath):
             if self._configured and not self._force_configure:
-                return True
+                if self._configured_digest == self._configure_digest():
+                    return True
+                self._logger.logln('Build options of %s changed, '
+                                   'reconfiguring.' % self.name)
         return False
 
+    # Whether the build dir was configured with other options. meson and
+    # cmake only apply the options they are given on top of the ones they
+    # already have, so those dropped since would stay. State from before
+    # the options were recorded doesn't know them; starting over for that
+    # would rebuild everything, so those are reconfigured in place.
+    def _options_changed(self):
+        return (self._configured and self._configured_digest is not None and
+                self._configured_buildpath == self.buildpath and
+                self._configured_digest != self._configure_digest())
+
+    # Inputs of autogen.sh. Makefile.am changes are picked up by the
+    # generated Makefiles themselves, so they don't need a new autogen run.
+    def _autotools_inputs_digest(self):
+        inputs = ['configure.ac', 'configure.in', 'autogen.sh', 'acinclude.m4']
+        m4dir = os.path.join(self.srcpath, 'm4')
+        if os.path.isdir(m4dir):
+            inputs += [os.path.join('m4', f) for f in sorted(os.listdir(m4dir))]
+
+        digest = hashlib.sha1()
+        for f in inputs:
+            try:
+                st = os.stat(os.path.join(self.srcpath, f))
+            except FileNotFoundError:
+                continue
+            digest.update(b'%s:%d:%d' % (f.encode(), st.st_size,
+                                         st.st_mtime_ns))
+        return digest.hexdigest()
+
     def _check_built(self):
-        if os.path.exists(self.buildpath) and os.path.isdir(self.buildpath):
+        # Packages restored from an artifact have no build dir
+        if (os.path.isdir(self.buildpath) or
+                self._artifact_key is not None):
             if self._built and not self._force_build:
-                # print(Gray('SKIP'))
-                return True
+                if self._built_fingerprint == self.fingerprint():
+                    return True
+                self._logger.logln('Fingerprint of %s changed: %s' %
+                                   (self.name, self.fingerprint()))
         return False
 
     def _build(self):
         if self._skipinstall:
             self._logger.logln('Skipping install of "%s"' % self.name)
+            self.outcome = 'skipped'
             return
 
-        print('Building %s: ' % self.name, end='')
+        if self._restore_artifact():
+            status('Building %s:' % self.label, Blue('CACHED'),
+                   self._installed_summary())
+            self.outcome = 'cached'
+            return
 
         build_func = {
             'meson': self._build_meson,
@@ -311,19 +1810,149 @@ class Pkg:
             'cmake': self._build_cmake,
         }
 
-        if self._buildsystem is not None:
-            build_func[self._buildsystem]()
-        elif os.path.exists(os.path.join(self.srcpath, 'meson.build')):
-            build_func['meson']()
-        elif os.path.exists(os.path.join(self.srcpath, 'autogen.sh')):
-            build_func['autotools']()
-        elif os.path.exists(os.path.join(self.srcpath, 'CMakeLists.txt')):
-            build_func['cmake']()
+        buildsystem = pkg_buildsystem(self._pkglist[self.name], self.srcpath)
+        if self._restored_current():
+            pass
+        elif buildsystem is not None:
+            build_func[buildsystem]()
+        else:
+            self._track_sources()
 
         if self._skipped:
-            print(Gray('SKIP'))
+            status('Building %s:' % self.label, Gray('SKIP'))
+            self.outcome = 'skipped'
         else:
-            print(Green('DONE'))
+            status('Building %s:' % self.label, Green('DONE'),
+                   self._installed_summary())
+            self.outcome = 'built'
+
+    # Packages without a build system only have their sources. They are
+    # recorded as installed once their sources are, like any other, so
+    # installs with nothing to do can tell they are current.
+    def _track_sources(self):
+        self._logger.logln('No build system found for "%s"' % self.name)
+        if self._installed and self._built_fingerprint == self.fingerprint():
+            return
+        self.built = True
+        self.installed = True
+
+    # Packages restored from an artifact have no build dir, so there is
+    # nothing to configure or build while they are current
+    def _restored_current(self):
+        return (self._artifact_key is not None and
+                not os.path.isdir(self.buildpath) and
+                self._installed and self._check_built())
+
+    def _installed_summary(self):
+        if self._updated_files is None:
+            return ''
+        return Gray('(%d of %d files updated)' % self._updated_files)
+
+    # Identifies the installed files of a package. Only clean source trees
+    # can be cached, and the prefix is part of the key since installed
+    # files like .pc and .la contain it.
+    def _cache_key(self):
+        fingerprint = self.fingerprint()
+        if not self._clean or None in self._deps_fingerprints:
+            return None
+
+        return ArtifactCache.key({
+            'name': self.name,
+            'head': fingerprint['head'],
+            'options': fingerprint['options'],
+            'configure': self._configure_digest(),
+            'toolchain': fingerprint['toolchain'],
+            'deps': self._deps_fingerprints,
+        })
+
+    def _restore_artifact(self):
+        if self._artifacts is None or self._force_build:
+            return False
+        if self._check_built():
+            return False
+
+        key = self._cache_key()
+        if key is None or self._artifacts.lookup(key) is None:
+            return False
+
+        self._logger.logln('Restoring %s from artifact %s' % (self.name, key))
+        shutil.rmtree(self._stage_dir, ignore_errors=True)
+        self._artifacts.extract(key, self._stage_dir)
+        files, updated = merge_tree(self._stage_dir, self._inst_dir)
+        shutil.rmtree(self._stage_dir, ignore_errors=True)
+        self._record_install(files, updated)
+        self._artifact_key = key
+        self.built = True
+        self.installed = True
+        return True
+
+    def _install_staged(self):
+        # DESTDIR keeps the full prefix path under the stage dir
+        staged = os.path.join(self._stage_dir, self._inst_dir.lstrip('/'))
+        if not os.path.isdir(staged):
+            raise Exception('%s installed nothing into %s' %
+                            (self.name, self._inst_dir))
+
+        for root, dirs, files in os.walk(self._stage_dir):
+            if root == staged:
+                dirs[:] = []
+                continue
+            for f in files:
+                self._logger.logln('Ignoring file installed out of prefix: ' +
+                                   os.path.join(root, f))
+
+        key = None
+        if self._artifacts is not None:
+            key = self._cache_key()
+            if key is not None:
+                self._logger.logln('Storing artifact %s' % key)
+                self._artifacts.store(key, staged, {'name': self.name})
+
+        files, updated = merge_tree(staged, self._inst_dir)
+        shutil.rmtree(self._stage_dir, ignore_errors=True)
+        self._record_install(files, updated)
+
+        self._artifact_key = key
+
+    # Saves the manifest of the files just installed, warning about those
+    # also installed by other packages, and removes what the previous
+    # install had and this one doesn't.
+    def _record_install(self, files, updated):
+        self._updated_files = (len(updated), len(files))
+        self.changed_files = set(updated)
+
+        owners = self._db.owners(self.name, self.variant)
+        old = self._db.manifest(self.name, self.variant)
+
+        # Variants of a package install the same headers, that's expected
+        variants = (pkg_label(self.name), pkg_label(self.name, True))
+        others = dict((f, [o for o in owners[f] if o not in variants])
+                      for f in files if f in owners)
+        collisions = sorted(f for f in others if others[f])
+        if collisions:
+            for f in collisions:
+                self._logger.logln('%s overwrote %s from %s' %
+                                   (self.label, f, ', '.join(others[f])))
+            status('%s:' % self.label,
+                   Yellow('%d files also installed by %s, like %s' %
+                          (len(collisions),
+                           ', '.join(sorted(set(o for f in collisions
+                                                for o in others[f]))),
+                           collisions[0])))
+
+        stale = [f for f in old if f not in files and f not in owners]
+        self.changed_files.update(stale)
+        for f in stale:
+            self._logger.logln('Removing stale file: ' + f)
+            remove_file(os.path.join(self._inst_dir, f), self._inst_dir)
+
+        manifest = []
+        for f in files:
+            digest = old.get(f)
+            if f in updated or digest is None:
+                digest = file_digest(os.path.join(self._inst_dir, f))
+            manifest.append((f, digest))
+        self._db.set_manifest(self.name, self.variant, manifest)
 
     def _build_meson(self):
         self._logger.logln('Building %s with meson.' % self.name)
@@ -361,27 +1990,80 @@ class Pkg:
 
         cmd.append('--libdir=%s' % libdir)
         cmd.append('--bindir=%s' % bindir)
+        if self._buildtype is not None:
+            cmd.append('--buildtype=%s' % self._buildtype)
         if self._build32:
             cmd.append('--cross-file=x86.txt')
 
         if mesonopts:
             cmd.extend(mesonopts.split())
+
+        # Reconfigure the existing build dir in place to keep its objects,
+        # unless options changed and it has to start from scratch
+        coredata = os.path.join(self.buildpath, 'meson-private', 'coredata.dat')
+        if os.path.exists(coredata):
+            if self._options_changed():
+                cmd.append('--wipe')
+            else:
+                cmd.append('--reconfigure')
+        os.makedirs(self.buildpath, exist_ok=True)
         cmd.append(self.buildpath)
 
-        self._call(cmd, self.srcpath)
+        env = self._env
+        ccache = self._ccache()
+        if ccache is not None:
+            # meson saves the compilers in the build dir at setup, turning
+            # ccache on or off changes the configure digest so it's wiped
+            env = dict(env)
+            env['CC'] = '%s %s' % (ccache, env.get('CC', 'cc'))
+            env['CXX'] = '%s %s' % (ccache, env.get('CXX', 'c++'))
 
-        self._configured = True
-        self.built = False
+        self._call(cmd, self.srcpath, env, phase='configure')
+
+        self._set_configured()
 
     def _call_ninja(self):
-        if self._check_built():
-            return
         cmd = ['ninja']
         cmd += ['-C', self.buildpath]
-        self._call(cmd, self.srcpath)
 
+        env = dict(self._env)
+        if (self._jobserver is not None and
+                self._env.get('BUILDER_NINJA_JOBSERVER')):
+            env['MAKEFLAGS'] = self._jobserver.makeflags(fifo=True)
+
+        if not self._check_built():
+            self._ninja_build(cmd, env)
+        elif self._installed:
+            return
+
+        shutil.rmtree(self._stage_dir, ignore_errors=True)
+        env['DESTDIR'] = self._stage_dir
         cmd.append('install')
-        self._call(cmd, self.srcpath)
+        self._call(cmd, self.srcpath, env, phase='install')
+        self._install_staged()
+        self.installed = True
+
+    def _ninja_build(self, cmd, env):
+        jobs = []
+        extra = 0
+        if (self._jobserver is not None and
+                not self._env.get('BUILDER_NINJA_JOBSERVER')):
+            extra, count = self._jobserver.fixed_jobs(os.cpu_count())
+            jobs = ['-j%d' % count]
+
+        ninja_log = os.path.join(self.buildpath, '.ninja_log')
+        try:
+            ninja_log_start = os.path.getsize(ninja_log)
+        except FileNotFoundError:
+            ninja_log_start = 0
+
+        try:
+            self._call(cmd + jobs, self.srcpath, env, phase='build')
+        finally:
+            if extra:
+                self._jobserver.release(extra)
+
+        self.ninja_targets = slowest_ninja_targets(ninja_log, ninja_log_start)
         self.built = True
 
     def _call_configure(self):
@@ -399,8 +2081,23 @@ class Pkg:
         m4dir = os.path.join(self.srcpath, 'm4')
         os.makedirs(m4dir, exist_ok=True)
 
-        cmd = ['./autogen.sh']
-        self._call(cmd, self.srcpath)
+        # Variants share the source tree, where autogen.sh generates its
+        # files, and only need it to run once
+        with source_lock(self.srcpath):
+            other = self._db.load_state(self.name,
+                                        pkg_variant(not self._build32))
+            done = set([self._autogen_digest])
+            if other is not None:
+                done.add(other['autogen'])
+
+            configure = os.path.join(self.srcpath, 'configure')
+            inputs = self._autotools_inputs_digest()
+            if (self._force_configure or not os.path.exists(configure) or
+                    inputs not in done):
+                cmd = ['./autogen.sh']
+                self._call(cmd, self.srcpath, phase='autogen')
+                inputs = self._autotools_inputs_digest()
+            self._autogen_digest = inputs
 
         libdir = 'lib64'
         bindir = 'bin'
@@ -411,25 +2108,48 @@ class Pkg:
         os.makedirs(self.buildpath, exist_ok=True)
         cmd = ['%s/configure' % self.srcpath]
         cmd.append('--prefix=%s' % self._inst_dir)
-        cmd.append('--libdir=%s' % libdir)
-        cmd.append('--bindir=%s' % bindir)
+        # configure only accepts absolute dirs
+        cmd.append('--libdir=%s' % os.path.join(self._inst_dir, libdir))
+        cmd.append('--bindir=%s' % os.path.join(self._inst_dir, bindir))
+        if self._buildtype is not None:
+            flags = self.AUTOTOOLS_BUILDTYPE_FLAGS[self._buildtype]
+            cmd.append('CFLAGS=%s' % self._env.get('CFLAGS', flags))
+            cmd.append('CXXFLAGS=%s' % self._env.get('CXXFLAGS', flags))
         if autoopts:
             cmd.extend(autoopts.split())
-        self._call(cmd, self.buildpath)
 
-        self._configured = True
-        self.built = False
+        ccache = self._ccache()
+        if ccache is not None:
+            cmd.append('CC=%s %s' % (ccache, self._env.get('CC', 'cc')))
+            cmd.append('CXX=%s %s' % (ccache, self._env.get('CXX', 'c++')))
+
+        self._call(cmd, self.buildpath, phase='configure')
+
+        self._set_configured()
 
     def _call_make(self):
-        if self._check_built():
-            return
         cmd = ['make']
-        cmd.append('-j%d' % os.cpu_count())
-        self._call(cmd, self.buildpath)
+        env = self._env
+        fds = ()
+        if self._jobserver is not None:
+            env = dict(env)
+            env['MAKEFLAGS'] = self._jobserver.makeflags()
+            fds = self._jobserver.fds
+        else:
+            cmd.append('-j%d' % os.cpu_count())
+
+        if not self._check_built():
+            self._call(cmd, self.buildpath, env, fds, phase='build')
+            self.built = True
+        elif self._installed:
+            return
 
+        shutil.rmtree(self._stage_dir, ignore_errors=True)
         cmd.append('install')
-        self._call(cmd, self.buildpath)
-        self.built = True
+        cmd.append('DESTDIR=%s' % self._stage_dir)
+        self._call(cmd, self.buildpath, env, fds, phase='install')
+        self._install_staged()
+        self.installed = True
 
     def _call_cmake(self):
         if self._check_configured():
@@ -449,34 +2169,688 @@ class Pkg:
         cmd.append('-DCMAKE_INSTALL_PREFIX=%s' % self._inst_dir)
         cmd.append('-DCMAKE_INSTALL_LIBDIR=%s' % libdir)
         cmd.append('-DCMAKE_INSTALL_BINDIR=%s' % bindir)
+        if self._buildtype is not None:
+            cmd.append('-DCMAKE_BUILD_TYPE=%s' %
+                       self.CMAKE_BUILDTYPES[self._buildtype])
         cmd.append('-GNinja')
         if cmakeopts:
             cmd.extend(cmakeopts.split())
 
-        self._call(cmd, self.buildpath)
-
-        self._configured = True
-        self.built = False
-
-    def install(self, build=False, configure=False):
+        # An empty launcher removes the one a previous configure cached
+        ccache = self._ccache() or ''
+        cmd.append('-DCMAKE_C_COMPILER_LAUNCHER=%s' % ccache)
+        cmd.append('-DCMAKE_CXX_COMPILER_LAUNCHER=%s' % ccache)
+
+        # Running cmake again on an existing build dir updates its cache and
+        # keeps the objects around. When options changed the cache starts
+        # over, so the ones no longer given get their defaults back.
+        if self._options_changed():
+            for f in ('CMakeCache.txt', 'CMakeFiles'):
+                path = os.path.join(self.buildpath, f)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+        self._call(cmd, self.buildpath, phase='configure')
+
+        self._set_configured()
+
+    def install(self, build=False, configure=False, deps_fingerprints=()):
         self._logger.logln('')
         self._logger.logln('Installing package: ' + self.name)
 
         self._force_build = build
         self._force_configure = configure
+        self._deps_fingerprints = list(deps_fingerprints)
+
+        if not os.path.isdir(self.srcpath):
+            raise Exception('Source of %s was not fetched' % self.name)
 
-        self._fetch()
         self._build()
 
-    def clean(self):
+    # Removes the files installed by the package, except those other
+    # packages installed too. Returns how many files were removed.
+    def uninstall(self):
         self._logger.logln('')
-        self._logger.logln('Cleaning package: ' + self.name)
-        cmd = ['git', 'clean', '-fdx']
-        if os.path.exists(self.srcpath):
-            self._call(cmd, self.srcpath)
-        if os.path.exists(self.buildpath):
-            shutil.rmtree(self.buildpath, ignore_errors=True)
-        os.remove(self.jsonpath)
+        self._logger.logln('Uninstalling package: ' + self.name)
+
+        owners = self._db.owners(self.name, self.variant)
+        removed = 0
+        for f in self._db.manifest(self.name, self.variant):
+            if f in owners:
+                self._logger.logln('Keeping %s, also installed by %s' %
+                                   (f, ', '.join(owners[f])))
+                continue
+            remove_file(os.path.join(self._inst_dir, f), self._inst_dir)
+            removed += 1
+
+        self._db.set_manifest(self.name, self.variant, [])
+        self._artifact_key = None
+        self.installed = False
+        return removed
+
+    # Cleans the given parts of the package, from CLEAN_SCOPES. Build dirs
+    # are moved into 'trashdir', or the trash of their build root, and
+    # deleted in the background.
+    def clean(self, scopes, trashdir):
+        self._logger.logln('')
+        self._logger.logln('Cleaning package: %s (%s)' %
+                           (self.label, ', '.join(scopes)))
+
+        if 'install' in scopes:
+            self.uninstall()
+
+        if 'build' in scopes:
+            for buildpath in set([self.buildpath, self._configured_buildpath]):
+                if buildpath is not None and os.path.exists(buildpath):
+                    remove_tree_async(buildpath,
+                                      self._trash_for(buildpath, trashdir))
+
+        if 'source' in scopes and os.path.exists(self.srcpath):
+            cmd = ['git', 'clean', '-fdx']
+            # Keep the build dirs not being cleaned
+            for build32 in (False, True):
+                if 'build' not in scopes or build32 != self._build32:
+                    buildpath = pkg_buildpath(self.srcpath, build32)
+                    cmd += ['-e', '/' + os.path.relpath(buildpath,
+                                                        self.srcpath)]
+            self._call(cmd, self.srcpath, phase='clean')
+
+        if 'state' in scopes:
+            self._db.delete_state(self.name, self.variant)
+
+def add_timings(run, name, timings, ninja_targets=None):
+    pkg = run['packages'].setdefault(name, {'phases': {}})
+    for t in timings:
+        phase = pkg['phases'].setdefault(t['phase'], {
+            'wall': 0.0, 'cpu': 0.0, 'maxrss': 0, 'calls': 0,
+        })
+        phase['wall'] += t['wall']
+        phase['cpu'] += t['cpu']
+        phase['maxrss'] = max(phase['maxrss'], t['maxrss'])
+        phase['calls'] += 1
+    if ninja_targets:
+        pkg['ninja'] = ninja_targets
+
+# Transactional store of everything builder knows about a repo: the state of
+# each package and variant, what they installed and the history of builds.
+# It can be used by several threads and processes at the same time.
+class StateDB:
+    SCHEMA_VERSION = 4
+    MAX_RUNS = 100
+    RECENT_RUNS = 5
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS state (
+            name TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            configured INTEGER NOT NULL DEFAULT 0,
+            configure_options TEXT,
+            autogen TEXT,
+            built INTEGER NOT NULL DEFAULT 0,
+            fingerprint TEXT,
+            installed INTEGER NOT NULL DEFAULT 0,
+            artifact TEXT,
+            buildpath TEXT,
+            build_root TEXT,
+            PRIMARY KEY (name, variant)
+        );
+        CREATE TABLE IF NOT EXISTS manifest (
+            name TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            path TEXT NOT NULL,
+            hash TEXT,
+            PRIMARY KEY (name, variant, path)
+        );
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            time REAL NOT NULL,
+            wall REAL
+        );
+        CREATE TABLE IF NOT EXISTS timings (
+            run INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            phase TEXT NOT NULL,
+            wall REAL,
+            cpu REAL,
+            maxrss INTEGER,
+            calls INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS timings_run ON timings (run);
+        CREATE TABLE IF NOT EXISTS ninja_targets (
+            run INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            target TEXT NOT NULL,
+            seconds REAL
+        );
+        CREATE TABLE IF NOT EXISTS memory (
+            run INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            peak INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS unfinished (
+            name TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            buildtype TEXT,
+            phase TEXT,
+            PRIMARY KEY (name, variant)
+        );
+    """
+
+    STATE_FIELDS = ('configured', 'configure_options', 'autogen', 'built',
+                    'fingerprint', 'installed', 'artifact', 'buildpath',
+                    'build_root')
+
+    def __init__(self, workdir):
+        import sqlite3
+
+        self._workdir = workdir
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(workdir, 'state.db'),
+                                   timeout=60, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version < self.SCHEMA_VERSION:
+            self._setup()
+
+    def close(self):
+        self._db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            # Takes the write lock now, so concurrent writers wait on the
+            # busy timeout instead of failing to upgrade their lock later
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _setup(self):
+        with self._transaction() as db:
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            if version >= self.SCHEMA_VERSION:
+                return
+            if version == 1:
+                # Installing was part of building
+                db.execute('ALTER TABLE state ADD COLUMN installed INTEGER '
+                           'NOT NULL DEFAULT 0')
+                db.execute('UPDATE state SET installed = built')
+            if 1 <= version <= 2:
+                # Build dirs were always next to the sources
+                db.execute('ALTER TABLE state ADD COLUMN buildpath TEXT')
+                db.execute('ALTER TABLE state ADD COLUMN build_root TEXT')
+            for statement in self.SCHEMA.split(';'):
+                if statement.strip():
+                    db.execute(statement)
+            self._migrate_json(db)
+            db.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+
+    # Imports the state from older versions, which kept one JSON file per
+    # package and a JSON line per run.
+    def _migrate_json(self, db):
+        pkgsdir = os.path.join(self._workdir, 'pkgs')
+        if os.path.isdir(pkgsdir):
+            for f in os.listdir(pkgsdir):
+                if not f.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(pkgsdir, f)) as jsonfile:
+                        pkg = json.load(jsonfile)
+                    state = pkg['state']
+                except (ValueError, KeyError):
+                    continue
+                # The old state was shared by all variants, and installing
+                # was part of building
+                state['installed'] = state.get('built', False)
+                self._save_state(db, pkg['name'], pkg_variant(False), state)
+            os.rename(pkgsdir, pkgsdir + '.migrated')
+
+        historypath = os.path.join(self._workdir, 'history.jsonl')
+        if os.path.exists(historypath):
+            with open(historypath) as history:
+                for line in history:
+                    try:
+                        self._add_run(db, json.loads(line))
+                    except (ValueError, KeyError):
+                        continue
+            os.rename(historypath, historypath + '.migrated')
+
+        indexpath = os.path.join(self._workdir, 'index.json')
+        if os.path.exists(indexpath):
+            os.remove(indexpath)
+
+    def _row_to_state(self, row):
+        state = dict(zip(self.STATE_FIELDS, row))
+        state['configured'] = bool(state['configured'])
+        state['built'] = bool(state['built'])
+        state['installed'] = bool(state['installed'])
+        if state['fingerprint'] is not None:
+            state['fingerprint'] = json.loads(state['fingerprint'])
+        return state
+
+    def load_state(self, name, variant):
+        rows = self._query('SELECT %s FROM state WHERE name = ? AND '
+                           'variant = ?' % ', '.join(self.STATE_FIELDS),
+                           (name, variant))
+        if not rows:
+            return None
+        return self._row_to_state(rows[0])
+
+    def states(self, variant):
+        rows = self._query('SELECT name, %s FROM state WHERE variant = ?' %
+                           ', '.join(self.STATE_FIELDS), (variant,))
+        return dict((row[0], self._row_to_state(row[1:])) for row in rows)
+
+    def _save_state(self, db, name, variant, state):
+        values = [state.get(field) for field in self.STATE_FIELDS]
+        fingerprint = self.STATE_FIELDS.index('fingerprint')
+        if values[fingerprint] is not None:
+            values[fingerprint] = json.dumps(values[fingerprint],
+                                             sort_keys=True)
+        db.execute('INSERT OR REPLACE INTO state (name, variant, %s) '
+                   'VALUES (?, ?, %s)' %
+                   (', '.join(self.STATE_FIELDS),
+                    ', '.join('?' * len(self.STATE_FIELDS))),
+                   [name, variant] + values)
+
+    def save_state(self, name, variant, state):
+        with self._transaction() as db:
+            self._save_state(db, name, variant, state)
+
+    # Marks the built packages among 'names' as needing a rebuild, and
+    # returns them
+    def invalidate(self, names, variant):
+        with self._transaction() as db:
+            invalidated = []
+            for name in names:
+                cursor = db.execute('UPDATE state SET built = 0, '
+                                    'fingerprint = NULL, installed = 0 '
+                                    'WHERE name = ? AND variant = ? AND '
+                                    'built', (name, variant))
+                if cursor.rowcount:
+                    invalidated.append(name)
+            return invalidated
+
+    def delete_state(self, name, variant):
+        with self._transaction() as db:
+            db.execute('DELETE FROM state WHERE name = ? AND variant = ?',
+                       (name, variant))
+
+    # Packages an install didn't finish, as (name, build32, buildtype,
+    # phase) with the phase that failed, or None if they didn't start
+    def set_unfinished(self, unfinished):
+        with self._transaction() as db:
+            db.execute('DELETE FROM unfinished')
+            db.executemany('INSERT INTO unfinished VALUES (?, ?, ?, ?)',
+                           [(name, pkg_variant(build32), buildtype, phase)
+                            for name, build32, buildtype, phase in unfinished])
+
+    def unfinished(self):
+        return [(name, variant == '32', buildtype, phase)
+                for name, variant, buildtype, phase in self._query(
+                        'SELECT name, variant, buildtype, phase FROM '
+                        'unfinished ORDER BY rowid')]
+
+    def set_manifest(self, name, variant, files):
+        with self._transaction() as db:
+            db.execute('DELETE FROM manifest WHERE name = ? AND variant = ?',
+                       (name, variant))
+            db.executemany('INSERT INTO manifest (name, variant, path, hash) '
+                           'VALUES (?, ?, ?, ?)',
+                           [(name, variant, path, digest)
+                            for path, digest in files])
+
+    # Files installed by anything other than 'name' in 'variant', mapped to
+    # the labels of who installed them, like 'mesa' or 'mesa [32]'
+    def owners(self, name, variant):
+        owners = {}
+        for path, owner, v in self._query('SELECT path, name, variant '
+                                          'FROM manifest WHERE name != ? OR '
+                                          'variant != ?', (name, variant)):
+            owners.setdefault(path, []).append(pkg_label(owner, v == '32'))
+        return owners
+
+    def manifest(self, name, variant):
+        return dict(self._query('SELECT path, hash FROM manifest WHERE '
+                                'name = ? AND variant = ?', (name, variant)))
+
+    def _add_run(self, db, run):
+        runid = db.execute('INSERT INTO runs (time, wall) VALUES (?, ?)',
+                           (run['time'], run.get('wall'))).lastrowid
+        for name, pkg in run['packages'].items():
+            for phase, t in pkg['phases'].items():
+                db.execute('INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (runid, name, phase, t['wall'], t['cpu'],
+                            t['maxrss'], t['calls']))
+            for seconds, target in pkg.get('ninja', []):
+                db.execute('INSERT INTO ninja_targets VALUES (?, ?, ?, ?)',
+                           (runid, name, target, seconds))
+            if 'memory' in pkg:
+                db.execute('INSERT INTO memory VALUES (?, ?, ?)',
+                           (runid, name, pkg['memory']))
+
+    def add_run(self, run):
+        with self._transaction() as db:
+            self._add_run(db, run)
+
+            oldest = db.execute('SELECT id FROM runs ORDER BY id DESC '
+                                'LIMIT 1 OFFSET ?', (self.MAX_RUNS,)).fetchone()
+            if oldest is not None:
+                for table in ('timings', 'ninja_targets', 'memory'):
+                    db.execute('DELETE FROM %s WHERE run <= ?' % table, oldest)
+                db.execute('DELETE FROM runs WHERE id <= ?', oldest)
+
+    # Most memory building 'label' took in its last RECENT_RUNS builds, in
+    # bytes, so estimates follow the package as it changes. Before that was
+    # sampled, its largest process times 'jobs', as up to that many can run
+    # at once. 0 if it wasn't built yet.
+    def peak_memory(self, label, jobs):
+        peak, = self._query('SELECT MAX(peak) FROM (SELECT peak FROM memory '
+                            'WHERE name = ? ORDER BY run DESC LIMIT ?)',
+                            (label, self.RECENT_RUNS))[0]
+        if peak is not None:
+            return peak
+        maxrss, = self._query('SELECT MAX(maxrss) FROM timings WHERE name = ?',
+                              (label,))[0]
+        return (maxrss or 0) * 1024 * jobs
+
+    # How long each package takes, the median of its durations in the last
+    # RECENT_RUNS runs in which it had something to do, in seconds
+    def durations(self):
+        walls = {}
+        for name, wall in self._query('SELECT name, SUM(wall) FROM timings '
+                                      'GROUP BY run, name ORDER BY run DESC'):
+            recent = walls.setdefault(name, [])
+            if len(recent) < self.RECENT_RUNS:
+                recent.append(wall)
+        return dict((name, sorted(w)[len(w) // 2])
+                    for name, w in walls.items())
+
+    # Returns the recorded runs, oldest first, in the same format used by
+    # add_run()
+    def runs(self):
+        runs = collections.OrderedDict()
+        for runid, start, wall in self._query('SELECT id, time, wall FROM runs '
+                                              'ORDER BY id'):
+            runs[runid] = {'time': start, 'wall': wall, 'packages': {}}
+
+        for runid, name, phase, wall, cpu, maxrss, calls in self._query(
+                'SELECT run, name, phase, wall, cpu, maxrss, calls '
+                'FROM timings ORDER BY rowid'):
+            pkg = runs[runid]['packages'].setdefault(name, {'phases': {}})
+            pkg['phases'][phase] = {
+                'wall': wall, 'cpu': cpu, 'maxrss': maxrss, 'calls': calls,
+            }
+
+        for runid, name, target, seconds in self._query(
+                'SELECT run, name, target, seconds FROM ninja_targets '
+                'ORDER BY rowid'):
+            pkg = runs[runid]['packages'].setdefault(name, {'phases': {}})
+            pkg.setdefault('ninja', []).append([seconds, target])
+
+        for runid, name, peak in self._query('SELECT run, name, peak FROM '
+                                             'memory ORDER BY rowid'):
+            pkg = runs[runid]['packages'].setdefault(name, {'phases': {}})
+            pkg['memory'] = peak
+
+        return list(runs.values())
+
+# Runs a function over a graph mapping each package to its dependencies. Up
+# to 'jobs' packages run at the same time, a package only starts after all its
+# dependencies succeeded, and a failure only skips the packages depending on
+# the failed one. 'waits' optionally maps packages to futures that must also
+# complete before they start, like the fetch of their sources.
+class Scheduler:
+
+    # A failure only stops the packages depending on it. With a 'stop'
+    # event, a failed build also sets it and no more packages are started
+    # by any scheduler sharing it. Failed fetches never set it, those are
+    # reported at the end.
+    def __init__(self, graph, jobs=1, stop=None):
+        self._graph = graph
+        self._jobs = max(1, jobs)
+        self._stop = stop
+
+        self.done = []
+        self.failed = {}
+        self.blocked = []
+        self.stopped = []
+
+        self._check_cycles()
+
+    def _check_cycles(self):
+        visited = set()
+        visiting = []
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                cycle = visiting[visiting.index(name):] + [name]
+                raise Exception('Dependency cycle: ' + ' -> '.join(cycle))
+            visiting.append(name)
+            for dep in self._graph[name]:
+                visit(dep)
+            visiting.pop()
+            visited.add(name)
+
+        for name in self._graph:
+            visit(name)
+
+    def _block_dependents(self, pending):
+        changed = True
+        while changed:
+            changed = False
+            for name in list(pending):
+                deps = self._graph[name]
+                if any(d in self.failed or d in self.blocked for d in deps):
+                    pending.remove(name)
+                    self.blocked.append(name)
+                    changed = True
+
+    def run(self, func, waits={}):
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        pending = list(self._graph)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            while pending or running:
+                for name in list(pending):
+                    future = waits.get(name)
+                    if future is None or not future.done():
+                        continue
+                    if future.exception() is not None:
+                        pending.remove(name)
+                        self.failed[name] = future.exception()
+
+                self._block_dependents(pending)
+
+                if self._stop is not None and self._stop.is_set():
+                    self.stopped += pending
+                    pending = []
+
+                for name in list(pending):
+                    if len(running) >= self._jobs:
+                        break
+                    future = waits.get(name)
+                    if future is not None and not future.done():
+                        continue
+                    if all(d in self.done for d in self._graph[name]):
+                        pending.remove(name)
+                        running[executor.submit(func, name)] = name
+
+                waiting = [waits[name] for name in pending
+                           if name in waits and not waits[name].done()]
+                if not running and not waiting:
+                    break
+
+                finished, _ = wait(list(running) + waiting,
+                                   return_when=FIRST_COMPLETED)
+                finished = [f for f in finished if f in running]
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        self.failed[name] = error
+                        if self._stop is not None:
+                            self._stop.set()
+                    else:
+                        self.done.append(name)
+
+        return len(self.failed) == 0
+
+# Progress of an install: what each package is doing, how far its ninja got
+# and when everything should be done, from the durations in previous runs.
+# On a terminal it's a status line kept below the output, otherwise a
+# summary printed every SUMMARY_INTERVAL seconds. 'graph' maps the labels
+# of the packages to the labels of their dependencies.
+class Progress:
+    REFRESH_INTERVAL = 0.5
+    SUMMARY_INTERVAL = 30
+    STEP_RE = re.compile(rb'^\[(\d+)/(\d+)\] ', re.MULTILINE)
+
+    def __init__(self, graph, durations, jobs, live):
+        self._graph = graph
+        self._durations = durations
+        known = [durations[label] for label in graph if label in durations]
+        self._default = sum(known) / len(known) if known else None
+        self._jobs = max(1, jobs)
+        self._live = live
+
+        self._lock = threading.Lock()
+        self._running = {}
+        self._finished = set()
+
+        self._stop = threading.Event()
+        self._refresher = threading.Thread(target=self._refresh, daemon=True)
+        self._refresher.start()
+
+    def start(self, label):
+        now = time.monotonic()
+        with self._lock:
+            self._running[label] = {
+                'start': now, 'phase': None, 'phase_start': now,
+                'steps': None,
+            }
+
+    def finish(self, label):
+        with self._lock:
+            self._running.pop(label, None)
+            self._finished.add(label)
+
+    # These are called for every chunk of output, so they only replace
+    # values for the refresher thread to pick up
+    def phase(self, label, phase):
+        state = self._running.get(label)
+        if state is not None:
+            state['phase'] = phase
+            state['phase_start'] = time.monotonic()
+            state['steps'] = None
+
+    def output(self, label, chunk):
+        steps = self.STEP_RE.findall(chunk)
+        state = self._running.get(label)
+        if steps and state is not None:
+            state['steps'] = (int(steps[-1][0]), int(steps[-1][1]))
+
+    # Seconds a running package still needs: extrapolated from ninja's
+    # progress when there is one, from its usual duration otherwise
+    def _remaining(self, label, state, now):
+        steps = state['steps']
+        if steps and steps[0]:
+            done, total = steps
+            return (now - state['phase_start']) * (total - done) / done
+        duration = self._durations.get(label, self._default)
+        if duration is None:
+            return None
+        return max(duration - (now - state['start']), 0)
+
+    def _fraction(self, label, state, now):
+        steps = state['steps']
+        if steps and steps[1]:
+            return float(steps[0]) / steps[1]
+        duration = self._durations.get(label)
+        if duration:
+            return min((now - state['start']) / duration, 0.99)
+        return None
+
+    # The longest chain of dependencies still to build, or all the work
+    # left spread over every job if that takes longer
+    def _eta(self, remaining):
+        finish = {}
+        def visit(label):
+            if label not in finish:
+                deps = [d for d in self._graph[label] if d in self._graph]
+                finish[label] = remaining[label] + max(
+                        [visit(d) for d in deps] or [0])
+            return finish[label]
+
+        critical = max([visit(label) for label in self._graph] or [0])
+        return max(critical, sum(remaining.values()) / self._jobs)
+
+    def _line(self):
+        now = time.monotonic()
+        with self._lock:
+            running = dict((label, dict(state))
+                           for label, state in self._running.items())
+            finished = set(self._finished)
+
+        remaining = {}
+        parts = []
+        for label, state in sorted(running.items(),
+                                   key=lambda item: item[1]['start']):
+            remaining[label] = self._remaining(label, state, now)
+            part = label
+            fraction = self._fraction(label, state, now)
+            if fraction is not None:
+                part += ' %d%%' % (100 * fraction)
+            elif state['phase'] is not None:
+                part += ' (%s)' % state['phase']
+            if remaining[label] is not None:
+                part += ' ' + format_duration(remaining[label])
+            parts.append(part)
+
+        for label in self._graph:
+            if label in finished:
+                remaining[label] = 0
+            elif label not in running:
+                remaining[label] = self._durations.get(label, self._default)
+
+        line = '[%d/%d' % (len(finished), len(self._graph))
+        if None not in remaining.values():
+            line += ', ETA ' + format_duration(self._eta(remaining))
+        return line + '] ' + ', '.join(parts)
+
+    def _refresh(self):
+        if self._live:
+            interval = self.REFRESH_INTERVAL
+        else:
+            interval = self.SUMMARY_INTERVAL
+
+        while not self._stop.wait(interval):
+            if self._live:
+                width = shutil.get_terminal_size().columns
+                set_status_line(self._line()[:width - 1])
+            elif self._running:
+                status('progress:', self._line())
+
+    def close(self):
+        self._stop.set()
+        self._refresher.join()
+        if self._live:
+            set_status_line('')
 
 class Builder:
 
@@ -487,7 +2861,7 @@ class Builder:
         self.__args = args
         self._repos = repos
 
-        if args.subparser in PKG_CMDS or args.subparser == 'env':
+        if args.subparser in REPO_CMDS:
             reponame = args.repo
             if reponame is None:
                 reponame = self._repos.use
@@ -555,6 +2929,10 @@ class Builder:
             raise Exception('Invalid packages: ' + str(invalid))
 
     def run(self):
+        if self.__command == 'install' and self._nothing_to_install():
+            status('Install:', Gray('nothing to do'))
+            return
+
         if self.__command in PKG_CMDS:
             # logger disabled when initializing repo
             self._logfile = os.path.join(self._base_dir, 'builder.log')
@@ -562,9 +2940,15 @@ class Builder:
         operation = {
                 'init': self.initialize,
                 'install': self.install,
+                'resume': self.resume,
+                'update': self.update,
+                'watch': self.watch,
+                'uninstall': self.uninstall,
                 'clean': self.clean,
                 'remove': self.remove,
                 'env': self.print_env,
+                'cache': self.cache,
+                'stats': self.stats,
                 }
 
         operation[self.__command]()
@@ -574,8 +2958,23 @@ class Builder:
         self._src_dir = os.path.join(basedir, 'src')
         self._build_dir = os.path.join(basedir, 'build')
         self._inst_dir = os.path.join(basedir, 'usr')
-
-        self._setup_envvars()
+        self._toolchain = None
+        self._artifacts = None
+        self._mirrors = None
+        self._jobserver = None
+        self._memory = None
+        self._progress = None
+        self._resume_variants = None
+        self._run = None
+        self._outcomes = None
+        self._run_lock = threading.Lock()
+        self._db = None
+        self._build_root = self._repos.build_root(
+                self.name, getattr(self.__args, 'build_root', None))
+
+        # 'env' only prints paths, don't bother
+        if self.__args.subparser != 'env':
+            self._setup_envvars()
 
     def _setup_envvars(self):
         env = os.environ.copy()
@@ -600,37 +2999,86 @@ class Builder:
         env['CMAKE_PREFIX_PATH'] = usr
         env['NOCONFIGURE'] = '1'
 
+        self._setup_ccache(env)
+
         self._env = env
 
-    def _write_mesa_file(self):
-        import os
-        import stat
+    def _setup_ccache(self, env):
+        self._ccache = None
 
-        mesapath = os.path.join(self._inst_dir, self.MESA_SCRIPT_NAME)
+        ccache = self._repos.ccache(getattr(self.__args, 'ccache', None))
+        if ccache is None:
+            return
+
+        ccache_bin = shutil.which('ccache', path=env['PATH'])
+        if ccache_bin is None:
+            print(Yellow('ccache enabled but not found in PATH, ignoring it.'))
+            return
 
+        self._ccache = ccache_bin
+        env['BUILDER_CCACHE'] = ccache_bin
+        env['CCACHE_DIR'] = ccache['dir']
+        # ccache evicts the least recently used entries past this size
+        env['CCACHE_MAXSIZE'] = ccache['max_size']
+        # Relative paths and no cwd in the hash, to share results between
+        # repos and worktrees in different directories
+        env['CCACHE_BASEDIR'] = self._base_dir
+        env['CCACHE_NOHASHDIR'] = '1'
+
+    def _mesa_file_content(self):
         content = '#!/usr/bin/env bash\n\n'
         content += self._env_content()
         content += '\n'
         content += 'exec $@\n'
+        return content
 
-        mesafile = open(mesapath, 'w')
-        mesafile.write(content)
-        mesafile.close()
-        st = os.stat(mesapath)
-        os.chmod(mesapath, st.st_mode | 0o111)
-
-    def _write_env_file(self):
-        envpath = os.path.join(self._inst_dir, self.ENV_NAME)
-
+    def _env_file_content(self):
         content = '#!/usr/bin/env bash\n\n'
         content += self._env_content()
+        return content
 
-        envfile = open(envpath, 'w')
-        envfile.write(content)
-        envfile.close()
+    def _env_files(self):
+        return (
+            (os.path.join(self._inst_dir, self.ENV_NAME),
+             self._env_file_content(), False),
+            (os.path.join(self._inst_dir, self.MESA_SCRIPT_NAME),
+             self._mesa_file_content(), True),
+        )
+
+    def _env_files_current(self):
+        for path, content, executable in self._env_files():
+            try:
+                with open(path) as f:
+                    if f.read() != content:
+                        return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    # Files are only rewritten when their content changes, to not disturb
+    # anything watching them
+    def _write_env_files(self):
+        for path, content, executable in self._env_files():
+            try:
+                with open(path) as f:
+                    if f.read() == content:
+                        continue
+            except FileNotFoundError:
+                pass
+
+            with open(path, 'w') as f:
+                f.write(content)
+            if executable:
+                st = os.stat(path)
+                os.chmod(path, st.st_mode | 0o111)
 
     def _print_env_eval(self):
-        print(self._env_content('; '))
+        content = self._env_content('; ') + '\n'
+        sys.stdout.write(content)
+        try:
+            self._repos.write_env_cache(self.name, content)
+        except OSError:
+            pass
 
     def _env_content(self, endl='\n'):
         content = 'export WLD=%s' % self._inst_dir + endl
@@ -666,21 +3114,121 @@ class Builder:
         os.makedirs(self._inst_dir, exist_ok=True)
         os.makedirs(self._env['ACLOCAL_PATH'], exist_ok=True)
 
-    def _process_pkg(self, pkgname, operation):
+    # The state DB is opened on first use, 'env' and 'init' never need it
+    def _statedb(self):
+        if self._db is None:
+            self._db = StateDB(self._work_dir)
+        return self._db
+
+    # The (build32, buildtype) pairs to build, from --variants or else from
+    # --32 and --buildtype
+    def _variants(self):
+        if self._resume_variants is not None:
+            return self._resume_variants
+        spec = getattr(self.__args, 'variants', None)
+        if spec is not None:
+            return parse_variants(spec)
+        return [(getattr(self.__args, 'build32', False),
+                 getattr(self.__args, 'buildtype', None))]
+
+    def _variant(self):
+        return self._variants()[0]
+
+    # Decides whether an install would do nothing, from the state DB and
+    # one 'git status' per package, without creating any Pkg or touching
+    # the log.
+    def _nothing_to_install(self):
+        args = self.__args
+        if args.build or args.configure:
+            return False
+        if not self._env_files_current():
+            return False
+
+        toolchain = toolchain_id(self._env)
+
+        # Fingerprints to compare with the sources, by package
+        pending = collections.OrderedDict()
+        for build32, buildtype in self._variants():
+            states = self._statedb().states(pkg_variant(build32))
+            for name in self._pkgs:
+                pkgconf = self._pkglist[name]
+                srcpath = os.path.join(self._src_dir, name)
+                if not os.path.isdir(srcpath):
+                    return False
+                if pkgconf.get('skipinstall', False):
+                    continue
+
+                state = states.get(name)
+                if (state is None or not state['installed'] or
+                        state['fingerprint'] is None):
+                    return False
+                fingerprint = state['fingerprint']
+                if (fingerprint['toolchain'] != toolchain or
+                        fingerprint['options'] != options_digest(
+                            pkgconf, build32, buildtype)):
+                    return False
+                buildpath = (state['buildpath'] or
+                             pkg_buildpath(srcpath, build32))
+                # Packages restored from an artifact have no build dir and
+                # were never configured, as in Pkg._restored_current(), and
+                # those without a build system have none either
+                plain = pkg_buildsystem(pkgconf, srcpath) is None
+                restored = (state['artifact'] is not None and
+                            not state['configured'] and
+                            not os.path.isdir(buildpath))
+                digest = configure_digest(pkgconf, build32, buildtype,
+                                          self._inst_dir,
+                                          self._ccache is not None)
+                if (not plain and not restored and
+                        state['configure_options'] != digest):
+                    return False
+                _, build_root = desired_buildpath(pkgconf, srcpath,
+                                                  self._base_dir, build32,
+                                                  self._build_root)
+                root = build_root['path'] if build_root is not None else None
+                if state['configured'] and state['build_root'] != root:
+                    return False
+                if (not plain and state['artifact'] is None and
+                        not os.path.isdir(buildpath)):
+                    return False
+                pending.setdefault(name, []).append(fingerprint)
+
+        # All the 'git status' run at the same time
+        statuses = [start_source_state(os.path.join(self._src_dir, name),
+                                       self._env)
+                    for name in pending]
+        uptodate = True
+        for (name, fingerprints), gitstatus in zip(pending.items(), statuses):
+            head, dirty, clean = finish_source_state(gitstatus)
+            for fingerprint in fingerprints:
+                if (fingerprint['head'] != head or
+                        fingerprint['dirty'] != dirty):
+                    uptodate = False
+
+        return uptodate
+
+    def _process_pkg(self, pkgname, operation, variant=None):
         self.logger.logln('')
 
-        try:
-            build32 = self.__args.build32
-            buildtype = self.__args.buildtype
-        except AttributeError:
-            build32 = False
-            buildtype = 'debug'
+        build32, buildtype = variant or self._variant()
 
         pkg = Pkg(self._pkglist, pkgname,
                 self._base_dir, self.logger, self._env,
-                build32, buildtype)
+                build32, buildtype, self._toolchain, self._artifacts,
+                self._jobserver, self._statedb(), self._mirrors,
+                self._progress, self._build_root)
 
-        operation(pkg)
+        try:
+            return operation(pkg)
+        except Exception:
+            pkg.outcome = 'failed'
+            raise
+        finally:
+            if self._run is not None:
+                with self._run_lock:
+                    add_timings(self._run, pkg.label, pkg.timings,
+                                pkg.ninja_targets)
+                    self._outcomes[pkg.label] = (pkg.outcome, pkg.phase)
 
     def initialize(self):
         repo_name = self.__args.name
@@ -691,12 +3239,11 @@ class Builder:
 
         self._setup_base(self.__args.path)
         os.makedirs(self._work_dir, exist_ok=True)
-        pkgspath = os.path.join(self._work_dir, 'pkgs')
-        os.makedirs(pkgspath, exist_ok=True)
+        StateDB(self._work_dir).close()
 
         jsonfile = os.path.join(self._work_dir, 'pkglist.json')
         shutil.copyfile(self.__args.jsonfile, jsonfile)
-        self._repos.add(repo_name, self._base_dir)
+        self._repos.add(repo_name, self._base_dir, self.__args.build_root)
 
     def remove(self):
         repo_name = self.__args.repo_name
@@ -710,31 +3257,623 @@ class Builder:
 
         self._make_dirs()
 
-        self._write_env_file()
-        self._write_mesa_file()
+        self._write_env_files()
 
         self.logger.logln("Starting build.")
 
-        for p in self._pkgs:
-            self._process_pkg(p, self._inst_pkg)
+        self._toolchain = toolchain_id(self._env)
+        self._artifacts = self._repos.artifacts(self.__args.artifacts)
+        self._mirrors = self._repos.mirrors(self.__args.mirrors)
+        self._fingerprints = {}
+        ccache_before = ccache_stats(self._env)
+
+        self._fetch_failed = {}
+
+        slots = self.__args.slots or self._repos.jobserver_slots()
+        self._jobserver = Jobserver(slots, self._env)
+        version = ninja_version(self._env)
+        if version is not None and version >= (1, 13):
+            self._env['BUILDER_NINJA_JOBSERVER'] = '1'
+        elif version is not None:
+            status(Yellow('ninja %d.%d can\'t share the jobserver, meson and '
+                          'cmake packages keep the number of jobs they '
+                          'start with' % version))
+
+        limit = self._repos.memory_limit(self.__args.memory_limit)
+        self._memory = None
+        if limit is not None:
+            self._memory = MemoryGovernor(limit, self._jobserver)
+
+        jobs = self.__args.jobs
+        if jobs is None:
+            jobs = self._jobserver.slots or os.cpu_count()
+
+        self._run = {'time': time.time(), 'packages': {}}
+        self._outcomes = {}
+        self._invalidated = []
+        self._scans = {}
+        try:
+            processed = set(self._pkgs)
+            schedulers = self._run_install(jobs)
+            # Packages invalidated by the ones just installed, which weren't
+            # part of this install, go in another round
+            while not (self._fetch_failed or
+                       any(s.failed or s.blocked or s.stopped
+                           for _, s in schedulers)):
+                extra = [p for p in self._pkglist
+                         if p in self._invalidated and p not in processed]
+                if not extra:
+                    break
+                status('Rebuilding dependents:', Bold(' '.join(extra)))
+                self._pkgs = extra
+                processed.update(extra)
+                schedulers = self._run_install(jobs)
+        finally:
+            if self._memory is not None:
+                self._memory.close()
+            self._jobserver.close()
+            self._run['wall'] = time.time() - self._run['time']
+            self._statedb().add_run(self._run)
+
+        self._report_jobserver()
+        self._report_memory()
+        self._report_ccache(ccache_before)
+        self._save_unfinished(schedulers)
+        self._report(schedulers)
+
+    # Installs again what the last install didn't finish, each package
+    # starting from the phase it failed in
+    def resume(self):
+        unfinished = self._statedb().unfinished()
+        if self.__args.packages:
+            unfinished = [u for u in unfinished
+                          if u[0] in self.__args.packages]
+        if not unfinished:
+            status('Resume:', Gray('nothing to do'))
+            return
+
+        for name, build32, buildtype, phase in unfinished:
+            if phase is not None:
+                status('Resuming %s:' % pkg_label(name, build32),
+                       Bold('from %s' % phase))
+
+        names = set(u[0] for u in unfinished)
+        self._pkgs = [p for p in self._pkglist if p in names]
+        self._resume_variants = []
+        for _, build32, buildtype, _ in unfinished:
+            if (build32, buildtype) not in self._resume_variants:
+                self._resume_variants.append((build32, buildtype))
+        self.install()
+
+    def update(self):
+        print('Update')
+
+        self._make_dirs()
+        self._mirrors = self._repos.mirrors(self.__args.mirrors)
+
+        moved, failed = self._run_update()
+        for pkgname, error in failed.items():
+            status('Failed to update %s:' % pkgname, Red(error))
+
+        if moved and not self.__args.fetch_only:
+            # Whatever depends on an updated package is checked too, and
+            # rebuilt if what it is built against changed
+            pkgs = list(self._pkglist)
+            graph = self._dep_graph(pkgs, self.__args.infer_deps)
+            affected = set(moved)
+            changed = True
+            while changed:
+                changed = False
+                for name in pkgs:
+                    if name not in affected and affected & set(graph[name]):
+                        affected.add(name)
+                        changed = True
+
+            self._pkgs = [p for p in pkgs if p in affected]
+            status('Rebuilding:', Bold(' '.join(self._pkgs)))
+            self.install()
+        elif not moved:
+            status('Update:', Gray('everything up to date'))
+
+        if failed:
+            raise Exception('Failed to update: ' + ' '.join(failed))
+
+    # Rebuilds the packages as their sources change, until interrupted
+    def watch(self):
+        print('Watch')
+
+        watched = list(self._pkgs)
+        try:
+            watcher = Inotify()
+        except (OSError, AttributeError) as e:
+            self.logger.logln('inotify not available (%s), polling' % e)
+            watcher = SourcePoller(self._env)
+
+        for name in watched:
+            srcpath = os.path.join(self._src_dir, name)
+            if os.path.isdir(srcpath):
+                skip = [pkg_buildpath(srcpath, b) for b in (False, True)]
+                watcher.add_tree(srcpath, name, skip)
+
+        self._watch_install(watched)
+        try:
+            while True:
+                status('Watching:', Gray(' '.join(watched)))
+                touched = watcher.wait()
+                # Wait for a burst of edits to be over
+                while True:
+                    more = watcher.wait(self.__args.debounce)
+                    if not more:
+                        break
+                    touched |= more
+                self._watch_install([p for p in watched if p in touched])
+        except KeyboardInterrupt:
+            print()
+        finally:
+            watcher.close()
+
+    def _watch_install(self, pkgs):
+        self._pkgs = pkgs
+        # Builds touch the source trees too, which usually changes nothing
+        if self._nothing_to_install():
+            return
+        try:
+            self.install()
+        except Exception as e:
+            self.logger.logln('Watch: install failed: %s' % e)
+            status('Install:', Red(e))
+
+    # Updates the sources of all packages at the same time. Returns the
+    # packages whose sources changed and the errors of those that failed.
+    def _run_update(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        moved = []
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.__args.fetch_jobs) as pool:
+            futures = [(p, pool.submit(self._update_task, p))
+                       for p in self._pkgs]
+            for pkgname, future in futures:
+                error = future.exception()
+                if error is not None:
+                    failed[pkgname] = error
+                elif future.result():
+                    moved.append(pkgname)
+        return moved, failed
+
+    def _update_task(self, pkgname):
+        try:
+            return self._process_pkg(pkgname, self._pull_pkg)
+        except Exception as e:
+            self.logger.logln('Failed to update %s: %s' % (pkgname, e))
+            status('Updating %s:' % pkgname, Red('FAILED'))
+            raise
+
+    def _pull_pkg(self, pkg):
+        return pkg.pull()
+
+    def _run_install(self, jobs):
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        with ThreadPoolExecutor(max_workers=self.__args.fetch_jobs) as fetcher:
+            fetches = {}
+            for p in self._pkgs:
+                fetches[p] = fetcher.submit(self._fetch_task, p)
+
+            if self.__args.infer_deps:
+                # Inferring dependencies needs all the sources around
+                wait(fetches.values())
+
+            graph = self._dep_graph(self._pkgs, self.__args.infer_deps)
+            self._graph = graph
+
+            # The variants are built at the same time, sharing the sources
+            # and the jobserver slots
+            variants = self._variants()
+            stop = threading.Event() if self.__args.fail_fast else None
+            schedulers = [(v, Scheduler(graph, jobs, stop)) for v in variants]
+
+            labels = {}
+            for build32, _ in variants:
+                for name, deps in graph.items():
+                    labels[pkg_label(name, build32)] = [pkg_label(d, build32)
+                                                        for d in deps]
+            live = sys.stdout.isatty() and not self.logger.verbose
+            self._progress = Progress(labels, self._statedb().durations(),
+                                      jobs, live)
+            try:
+                with ThreadPoolExecutor(max_workers=len(variants)) as pool:
+                    runs = [pool.submit(s.run,
+                                        functools.partial(self._inst_task,
+                                                          variant=v),
+                                        fetches)
+                            for v, s in schedulers]
+                    for run in runs:
+                        run.result()
+            finally:
+                self._progress.close()
+                self._progress = None
+
+        return schedulers
+
+    def _dep_graph(self, pkgs, infer=False):
+        scans = {}
+        if infer:
+            for name in pkgs:
+                srcpath = os.path.join(self._src_dir, name)
+                if os.path.isdir(srcpath):
+                    scans[name] = scan_build_files(srcpath)
+
+        providers = dict((name, name) for name in pkgs)
+        for name, (provides, requires) in scans.items():
+            for module in provides:
+                providers.setdefault(module, name)
+
+        graph = {}
+        for i, name in enumerate(pkgs):
+            pkgconf = self._pkglist[name]
+            if 'deps' in pkgconf:
+                self.check_packages(pkgconf['deps'])
+                deps = [d for d in pkgconf['deps'] if d in pkgs]
+            elif name in scans:
+                requires = scans[name][1]
+                deps = [p for p in pkgs[:i] + pkgs[i + 1:]
+                        if any(providers.get(m) == p for m in requires)]
+            else:
+                # No known dependencies, keep the order from pkglist.json
+                deps = pkgs[:i]
+
+            self.logger.logln('Dependencies of %s: %s' % (name, deps))
+            graph[name] = deps
+
+        return graph
+
+    def _fetch_task(self, pkgname):
+        try:
+            self._process_pkg(pkgname, self._fetch_pkg)
+        except Exception as e:
+            self.logger.logln('Failed to fetch %s: %s' % (pkgname, e))
+            status('Fetching %s:' % pkgname, Red('FAILED'))
+            self._fetch_failed[pkgname] = e
+            raise
+
+    def _fetch_pkg(self, pkg):
+        pkg.fetch()
+
+    def _inst_task(self, pkgname, variant):
+        label = pkg_label(pkgname, variant[0])
+        if self._memory is not None:
+            jobs = self._jobserver.slots or os.cpu_count()
+            self._memory.admit(label,
+                               self._statedb().peak_memory(label, jobs))
+        # This token is the slot of the package's main build process
+        self._jobserver.acquire_build()
+        self._progress.start(label)
+        try:
+            self._process_pkg(pkgname, self._inst_pkg, variant)
+        except Exception as e:
+            self.logger.logln('Failed to install %s: %s' % (label, e))
+            status('Installing %s:' % label, Red('FAILED'))
+            raise
+        finally:
+            self._progress.finish(label)
+            self._jobserver.release_build()
+            if self._memory is not None:
+                growth = self._memory.done(label)
+                with self._run_lock:
+                    pkg = self._run['packages'].get(label)
+                    if pkg is not None and pkg['phases']:
+                        pkg['memory'] = growth
+
+    def _report_jobserver(self):
+        usage = self._jobserver.usage()
+        if usage is None:
+            return
+        average, peak, full = usage
+        status('jobserver:', Bold('%d slots, %.1f used on average, peak %d, '
+                                  'all in use %.0f%% of the time' %
+                                  (self._jobserver.slots, average, peak,
+                                   full)))
+
+    def _report_memory(self):
+        memory = self._memory
+        if memory is None:
+            return
+        report = 'peak %s used of %s allowed' % (format_size(memory.peak),
+                                                 format_size(memory.limit))
+        if memory.delayed:
+            report += ', %d packages delayed' % memory.delayed
+        if memory.max_withheld:
+            report += ', up to %d slots held back' % memory.max_withheld
+        status('memory:', Bold(report))
+
+    def _report_ccache(self, before):
+        after = ccache_stats(self._env)
+        if before is None or after is None:
+            return
+
+        hits = after[0] - before[0]
+        misses = after[1] - before[1]
+        if hits + misses == 0:
+            return
+        rate = 100.0 * hits / (hits + misses)
+        status('ccache:', Bold('%d hits, %d misses (%.1f%%)' %
+                               (hits, misses, rate)))
+
+    # The phase a package failed in, which 'resume' restarts it from
+    def _failed_phase(self, pkgname, build32):
+        if pkgname in self._fetch_failed:
+            return 'fetch'
+        return self._outcomes.get(pkg_label(pkgname, build32), (None,))[-1]
+
+    # Remembers what 'resume' has to finish: the failed packages and those
+    # not built because of them
+    def _save_unfinished(self, schedulers):
+        unfinished = []
+        for (build32, buildtype), scheduler in schedulers:
+            for p in scheduler.failed:
+                unfinished.append((p, build32, buildtype,
+                                   self._failed_phase(p, build32)))
+            for p in scheduler.blocked + scheduler.stopped:
+                unfinished.append((p, build32, buildtype, None))
+        self._statedb().set_unfinished(unfinished)
+
+    def _report(self, schedulers):
+        for pkgname, error in self._fetch_failed.items():
+            status('Failed to fetch %s:' % pkgname, Red(error))
+
+        blocked = []
+        stopped = []
+        failed = []
+        for (build32, buildtype), scheduler in schedulers:
+            blocked += [pkg_label(p, build32) for p in scheduler.blocked]
+            stopped += [pkg_label(p, build32) for p in scheduler.stopped]
+            for p in scheduler.failed:
+                phase = self._failed_phase(p, build32)
+                label = pkg_label(p, build32)
+                failed.append('%s (%s)' % (label, phase) if phase else label)
+
+        if blocked:
+            status('Not built due to failed dependencies:',
+                   Yellow(', '.join(blocked)))
+        if stopped:
+            status('Not built after the failure, due to --fail-fast:',
+                   Yellow(', '.join(stopped)))
+
+        counts = collections.Counter(outcome for outcome, _ in
+                                     self._outcomes.values())
+        summary = ['%d built' % counts['built'],
+                   '%d cached' % counts['cached'],
+                   '%d up to date' % counts['skipped']]
+        if failed:
+            summary.append(Red('%d failed' % len(failed)))
+        if blocked or stopped:
+            summary.append(Yellow('%d not built' % (len(blocked) +
+                                                     len(stopped))))
+        status('Summary:', ', '.join(str(s) for s in summary))
+
+        if failed:
+            status('Resume with:', Bold('builder resume'))
+            raise Exception('Failed packages: ' + ', '.join(failed))
+
+    def _saved_fingerprint(self, pkgname, build32):
+        state = self._statedb().load_state(pkgname, pkg_variant(build32))
+        if state is None or not state['installed']:
+            return None
+        return state['fingerprint']
+
+    # Fingerprints of what a package is built against, part of its artifact
+    # key. Declared deps outside of this run are read from their state.
+    def _deps_fingerprints(self, pkgname, build32):
+        fingerprints = []
+        for dep in artifact_deps(pkgname, self._graph, self._pkglist):
+            if (dep, build32) not in self._fingerprints:
+                self._fingerprints[dep, build32] = \
+                        self._saved_fingerprint(dep, build32)
+            fingerprints.append(self._fingerprints[dep, build32])
+        return fingerprints
 
     def _inst_pkg(self, pkg):
         force_build = self.__args.build
         force_configure = self.__args.configure
-        pkg.install(build=force_build, configure=force_configure)
+        pkg.install(build=force_build, configure=force_configure,
+                    deps_fingerprints=self._deps_fingerprints(pkg.name,
+                                                              pkg.build32))
+        self._fingerprints[pkg.name, pkg.build32] = pkg.built_fingerprint
+        self._invalidate_dependents(pkg)
         return
 
+    # Packages built against the files of 'pkgname': those listing it in
+    # "invalidated_by" in pkglist.json, or else those requiring one of the
+    # pkg-config modules it installed
+    def _consumers(self, pkgname, variant):
+        modules = set(os.path.basename(f)[:-len('.pc')]
+                      for f in self._statedb().manifest(pkgname, variant)
+                      if f.endswith('.pc'))
+
+        consumers = []
+        for name, pkgconf in self._pkglist.items():
+            if name == pkgname:
+                continue
+            if 'invalidated_by' in pkgconf:
+                if pkgname in pkgconf['invalidated_by']:
+                    consumers.append(name)
+                continue
+
+            scan = self._scans.get(name)
+            if scan is None:
+                srcpath = os.path.join(self._src_dir, name)
+                if not os.path.isdir(srcpath):
+                    continue
+                scan = self._scans[name] = scan_build_files(srcpath)
+            if modules & scan[1]:
+                consumers.append(name)
+        return consumers
+
+    # Marks the packages built against what 'pkg' just installed as needing
+    # a rebuild, if any of its headers, libraries or .pc files changed
+    def _invalidate_dependents(self, pkg):
+        changed = [f for f in pkg.changed_files if interface_file(f)]
+        if not changed:
+            return
+
+        consumers = self._consumers(pkg.name, pkg.variant)
+        invalidated = self._statedb().invalidate(consumers, pkg.variant)
+        if not invalidated:
+            return
+
+        self.logger.logln('%s changed %s, invalidating %s' %
+                          (pkg.name, ' '.join(sorted(changed)),
+                           ' '.join(invalidated)))
+        status('Invalidated by %s:' % pkg.label,
+               Yellow(' '.join(invalidated)))
+        with self._run_lock:
+            self._invalidated.extend(invalidated)
+
+    def cache(self):
+        artifacts = self._repos.artifacts(True)
+
+        if self.__args.action == 'clear':
+            removed = artifacts.prune(0)
+        elif self.__args.action == 'prune':
+            max_size = self.__args.max_size
+            if max_size is None:
+                max_size = artifacts.max_size
+            removed = artifacts.prune(parse_size(max_size))
+        else:
+            removed = None
+
+        if removed is not None:
+            size = sum(e['size'] for e in removed)
+            print('Removed %d artifacts (%s)' % (len(removed),
+                                                 format_size(size)))
+            return
+
+        entries = artifacts.entries()
+        total = 0
+        for e in entries:
+            total += e['size']
+            used = time.strftime('%Y-%m-%d %H:%M', time.localtime(e['used']))
+            print('%s  %-20s %8s  %s' % (e['key'][:16], e.get('name', '?'),
+                                         format_size(e['size']), used))
+        print()
+        print('%d artifacts, %s of %s' % (len(entries), format_size(total),
+                                          format_size(artifacts.max_size)))
+
+    def stats(self):
+        runs = [r for r in self._statedb().runs() if r['packages']]
+        if not runs:
+            print('No builds recorded yet.')
+            return
+
+        latest = runs[-1]
+        previous = runs[-1 - self.__args.runs:-1]
+        threshold = self.__args.threshold / 100.0
+
+        packages = self.__args.packages or list(latest['packages'])
+        started = time.strftime('%Y-%m-%d %H:%M',
+                                time.localtime(latest['time']))
+        print('Latest run: %s, %.1fs (compared to %d previous runs)' %
+              (started, latest.get('wall', 0.0), len(previous)))
+        print()
+        print('%-20s %-10s %9s %9s %8s %9s' %
+              ('package', 'phase', 'wall', 'cpu', 'maxrss', 'before'))
+
+        phase_totals = collections.OrderedDict()
+        regressions = []
+        for name in packages:
+            pkg = latest['packages'].get(name)
+            if pkg is None:
+                continue
+            for phase, t in pkg['phases'].items():
+                total = phase_totals.setdefault(phase, [0.0, 0.0])
+                total[0] += t['wall']
+                total[1] += t['cpu']
+
+                before = [r['packages'][name]['phases'][phase]['wall']
+                          for r in previous
+                          if phase in r['packages'].get(name, {})
+                                                   .get('phases', {})]
+                line = '%-20s %-10s %8.1fs %8.1fs %8s' % (
+                        name, phase, t['wall'], t['cpu'],
+                        format_size(t['maxrss'] * 1024))
+                if before:
+                    avg = sum(before) / len(before)
+                    line += ' %8.1fs' % avg
+                    # Ignore noise in short phases
+                    if (t['wall'] > avg * (1 + threshold) and
+                            t['wall'] - avg > 1.0):
+                        line += ' ' + str(Red('+%.0f%%' %
+                                              (100 * (t['wall'] / avg - 1))))
+                        regressions.append((name, phase))
+                print(line)
+
+        print()
+        print('Per phase:')
+        for phase, (wall, cpu) in phase_totals.items():
+            print('  %-10s %8.1fs wall %8.1fs cpu' % (phase, wall, cpu))
+
+        for name in packages:
+            targets = latest['packages'].get(name, {}).get('ninja')
+            if not targets:
+                continue
+            print()
+            print('Slowest targets of %s:' % name)
+            for duration, target in targets:
+                print('  %8.1fs %s' % (duration, target))
+
+        if regressions:
+            print()
+            print(Red('Regressions: ' + ', '.join('%s (%s)' % r
+                                                 for r in regressions)))
+
+    def uninstall(self):
+        print('Uninstall')
+
+        self.logger.logln("Starting uninstall.")
+
+        for p in self._pkgs:
+            self._process_pkg(p, self._uninstall_pkg)
+
+    def _uninstall_pkg(self, pkg):
+        removed = pkg.uninstall()
+        status('Uninstalling %s:' % pkg.name,
+               Green('DONE') if removed else Gray('SKIP'),
+               Gray('(%d files)' % removed))
+
     def clean(self):
         print('Clean')
 
         self.logger.logln("Starting cleaning.")
 
-        for p in self._pkgs:
-            self._process_pkg(p, self._clean_pkg)
+        scopes = self.__args.scope.split(',')
+        invalid = [s for s in scopes if s not in CLEAN_SCOPES]
+        if invalid:
+            raise Exception('Invalid clean scopes: %s, must be from: %s' %
+                            (', '.join(invalid), ', '.join(CLEAN_SCOPES)))
+        self._clean_scopes = scopes
+
+        # Leftovers of previous cleans that got interrupted
+        self._trash_dir = os.path.join(self._work_dir, 'trash')
+        roots = [self._build_root]
+        roots += [parse_build_root(pkgconf['build_root'])
+                  for pkgconf in self._pkglist.values()
+                  if 'build_root' in pkgconf]
+        trashes = [self._trash_dir]
+        trashes += [build_root_trash(root['path'])
+                    for root in roots if root is not None]
+        for trash in set(trashes):
+            if os.path.isdir(trash):
+                for f in os.listdir(trash):
+                    empty_trash(os.path.join(trash, f))
+
+        for variant in self._variants():
+            for p in self._pkgs:
+                self._process_pkg(p, self._clean_pkg, variant)
 
     def _clean_pkg(self, pkg):
-        self.logger.logln('Cleaning package: ' + str(pkg))
-        pkg.clean()
+        pkg.clean(self._clean_scopes, self._trash_dir)
+        status('Cleaning %s:' % pkg.label, Green('DONE'))
 
 def main():
     parser = argparse.ArgumentParser(description='Builder for mesa')
@@ -757,6 +3896,9 @@ def main():
             help='path to initialize builder')
     init_p.add_argument('--jsonfile', '-f', required=True,
             help='json file used to initialize')
+    init_p.add_argument('--build-root', type=str,
+            help='dir to put the build dirs in, like a tmpfs or a fast '
+                 'local disk, instead of next to the sources')
 
     # Use this directory
     use_p = commands.add_parser('use',
@@ -772,29 +3914,131 @@ def main():
 
     # Print env
     use_p = commands.add_parser('env',
-            help='output env setup')
+            help='output env setup, also kept in %s/<repo>.sh for shells '
+                 'to source directly' % ENV_CACHE_DIR)
 
-    # Install packages
-    install_p = commands.add_parser('install',
-            parents=[pkg_parser],
-            help='build and install packages')
+    # Options of the commands that build packages
+    build_parser = argparse.ArgumentParser(add_help=False)
 
-    install_p.add_argument('--build', '-b', action='store_true',
+    build_parser.add_argument('--build', '-b', action='store_true',
             help='force rebuild package if already built')
 
-    install_p.add_argument('--configure', '-c', action='store_true',
+    build_parser.add_argument('--configure', '-c', action='store_true',
             help='force reconfigure package if already configured')
 
-    install_p.add_argument('--32', action='store_true', dest='build32',
+    build_parser.add_argument('--32', action='store_true', dest='build32',
             help='build 32 bits version')
 
-    install_p.add_argument('--buildtype', type=str, choices={'debug', 'debugoptimized', 'release'},
+    build_parser.add_argument('--jobs', '-j', type=int,
+            help='max number of packages to build at the same time '
+                 '(default: number of jobserver slots)')
+
+    build_parser.add_argument('--slots', type=int,
+            help='total number of build jobs shared by all packages '
+                 '(default from builder.conf, or number of CPUs)')
+
+    build_parser.add_argument('--build-root', type=str,
+            help='dir to put new build dirs in, or "none" to keep them next '
+                 'to the sources (default from builder.conf)')
+
+    build_parser.add_argument('--fail-fast', action='store_true',
+            help='start no more packages after one fails to build, instead '
+                 'of only skipping those depending on it')
+
+    build_parser.add_argument('--memory-limit', metavar='LIMIT',
+            help='memory the machine may use while building, like 16G or '
+                 '90%%, or "none" (default from builder.conf, or 90%%)')
+
+    build_parser.add_argument('--fetch-jobs', type=int, default=8,
+            help='number of sources to fetch at the same time')
+
+    build_parser.add_argument('--ccache', action=argparse.BooleanOptionalAction,
+            help='use the shared compiler cache (default from builder.conf)')
+
+    build_parser.add_argument('--infer-deps', action='store_true',
+            help='infer dependencies of packages that do not declare "deps"')
+
+    build_parser.add_argument('--buildtype', type=str, choices=BUILDTYPES,
             help='build type')
 
+    build_parser.add_argument('--variants', type=str,
+            help='comma separated variants to build at the same time, like '
+                 '64:debugoptimized,32:debug (overrides --32 and '
+                 '--buildtype)')
+
+    build_parser.add_argument('--artifacts',
+            action=argparse.BooleanOptionalAction,
+            help='use the shared cache of installed packages '
+                 '(default from builder.conf)')
+
+    build_parser.add_argument('--mirrors',
+            action=argparse.BooleanOptionalAction,
+            help='clone sources from the shared mirrors of upstream repos '
+                 '(default from builder.conf)')
+
+    # Install packages
+    install_p = commands.add_parser('install',
+            parents=[pkg_parser, build_parser],
+            help='build and install packages')
+
+    # Resume an install
+    resume_p = commands.add_parser('resume',
+            parents=[pkg_parser, build_parser],
+            help='finish the last install, restarting each package that '
+                 'failed from the failed phase')
+
+    # Update sources
+    update_p = commands.add_parser('update',
+            parents=[pkg_parser, build_parser],
+            help='fetch new commits and rebuild the packages that changed')
+
+    update_p.add_argument('--fetch-only', action='store_true',
+            help='only update the sources, do not rebuild anything')
+
+    # Rebuild packages as they are edited
+    watch_p = commands.add_parser('watch',
+            parents=[pkg_parser, build_parser],
+            help='rebuild and install packages as their sources change')
+
+    watch_p.add_argument('--debounce', type=float, default=0.5,
+            help='seconds without changes to wait for before building')
+
+    # Artifact cache
+    cache_p = commands.add_parser('cache',
+            help='inspect and prune the cache of installed packages')
+    cache_p.add_argument('action', nargs='?', default='list',
+            choices=('list', 'prune', 'clear'),
+            help='what to do with the cache')
+    cache_p.add_argument('--max-size', type=str,
+            help='size to prune the cache down to, like 5G')
+
+    # Build statistics
+    stats_p = commands.add_parser('stats',
+            parents=[pkg_parser],
+            help='show time and resources used by the last install')
+    stats_p.add_argument('--runs', type=int, default=5,
+            help='number of previous runs to compare with')
+    stats_p.add_argument('--threshold', type=float, default=20,
+            help='slowdown in percent reported as a regression')
+
+    # Uninstall packages
+    uninstall_p = commands.add_parser('uninstall',
+            parents=[pkg_parser],
+            help='remove the files installed by packages')
+    uninstall_p.add_argument('--32', action='store_true', dest='build32',
+            help='uninstall the 32 bits version')
+
     # Clean packages
     clean_p = commands.add_parser('clean',
             parents=[pkg_parser],
-            help='clean package source dir')
+            help='clean build dirs, state, installed files or sources')
+    clean_p.add_argument('--scope', default='build,state',
+            help='comma separated parts to clean, from %s (default: '
+                 'build,state)' % ', '.join(CLEAN_SCOPES))
+    clean_p.add_argument('--32', action='store_true', dest='build32',
+            help='clean the 32 bits version')
+    clean_p.add_argument('--variants', type=str,
+            help='comma separated variants to clean, like 64,32')
 
     args = parser.parse_args()
 
@@ -805,7 +4049,7 @@ def main():
         return
 
     if repos.use is None:
-        if args.repo is None and args.subparser in PKG_CMDS:
+        if args.repo is None and args.subparser in REPO_CMDS:
             print('No default repo set, need to specify one.')
             print('Use option --repo')
             return
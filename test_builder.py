@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Checks of the parts of builder that don't need any build tool. Run with
+# 'python3 -m unittest test_builder'.
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future
+
+import builder
+
+class FilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, path, content, mode=0o644):
+        path = os.path.join(self.tmpdir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, mode)
+        return path
+
+    def test_same_file(self):
+        a = self.write('a', 'content')
+        b = self.write('b', 'content')
+        self.assertTrue(builder.same_file(a, b))
+        self.assertFalse(builder.same_file(a, self.write('c', 'other!!')))
+        self.assertFalse(builder.same_file(a, self.write('d', 'content',
+                                                         0o755)))
+        self.assertFalse(builder.same_file(a, os.path.join(self.tmpdir, 'e')))
+
+        la = os.path.join(self.tmpdir, 'la')
+        lb = os.path.join(self.tmpdir, 'lb')
+        os.symlink('a', la)
+        os.symlink('a', lb)
+        self.assertTrue(builder.same_file(la, lb))
+        # Symlinks are not followed
+        self.assertFalse(builder.same_file(la, a))
+
+    def test_merge_tree(self):
+        self.write('src/same', 'same')
+        self.write('src/lib/changed', 'new')
+        self.write('src/lib/new', 'new')
+        self.write('src/replaced', 'file')
+        os.symlink('lib', os.path.join(self.tmpdir, 'src', 'link'))
+
+        same = self.write('dst/same', 'same')
+        os.utime(same, (1000, 1000))
+        self.write('dst/lib/changed', 'old')
+        self.write('dst/replaced/file', 'dir')
+        self.write('dst/kept', 'kept')
+
+        src = os.path.join(self.tmpdir, 'src')
+        dst = os.path.join(self.tmpdir, 'dst')
+        files, updated = builder.merge_tree(src, dst)
+
+        self.assertEqual(sorted(files), ['lib/changed', 'lib/new', 'link',
+                                         'replaced', 'same'])
+        self.assertEqual(updated, {'lib/changed', 'lib/new', 'link',
+                                   'replaced'})
+        # Files with the same contents keep their timestamps
+        self.assertEqual(os.stat(same).st_mtime, 1000)
+        with open(os.path.join(dst, 'lib', 'changed')) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertTrue(os.path.isfile(os.path.join(dst, 'replaced')))
+        self.assertEqual(os.readlink(os.path.join(dst, 'link')), 'lib')
+        self.assertTrue(os.path.exists(os.path.join(dst, 'kept')))
+
+class GitStatus:
+    def __init__(self, srcpath, output, returncode=0):
+        self.srcpath = srcpath
+        self.returncode = returncode
+        self._output = output
+
+    def communicate(self):
+        return self._output, None
+
+class SourceStateTest(unittest.TestCase):
+    HEAD = '# branch.oid 0123456789abcdef0123456789abcdef01234567'
+
+    def setUp(self):
+        self.srcpath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.srcpath)
+
+    def state(self, *entries, returncode=0):
+        output = '\0'.join((self.HEAD,) + entries + ('',)).encode()
+        return builder.finish_source_state(GitStatus(self.srcpath, output,
+                                                     returncode))
+
+    def test_clean(self):
+        head, dirty, clean = self.state('# branch.head main')
+        self.assertEqual(head, self.HEAD.split()[-1])
+        self.assertTrue(clean)
+        self.assertEqual(dirty, self.state()[1])
+
+    def test_changes(self):
+        with open(os.path.join(self.srcpath, 'my file.c'), 'w') as f:
+            f.write('int a;')
+        modified = ('1 .M N... 100644 100644 100644 0123 0123 my file.c')
+        head, dirty, clean = self.state(modified)
+        self.assertFalse(clean)
+        self.assertNotEqual(dirty, self.state()[1])
+
+        # Editing the file again changes the digest
+        with open(os.path.join(self.srcpath, 'my file.c'), 'a') as f:
+            f.write('int b;')
+        self.assertNotEqual(self.state(modified)[1], dirty)
+
+    def test_entries(self):
+        renamed = '2 R. N... 100644 100644 100644 0123 0123 R100 new.c'
+        conflict = ('u UU N... 100644 100644 100644 100644 0123 0123 0123 '
+                    'conflict.c')
+        # The original path of a rename isn't an entry of its own
+        head, dirty, clean = self.state(renamed, '1 old.c', conflict,
+                                        '? untracked.c')
+        self.assertFalse(clean)
+        self.assertIsNotNone(head)
+
+    def test_failure(self):
+        with self.assertRaises(Exception):
+            self.state(returncode=128)
+
+class VariantsTest(unittest.TestCase):
+    def test_parse_variants(self):
+        self.assertEqual(builder.parse_variants('64:debugoptimized,32:debug'),
+                         [(False, 'debugoptimized'), (True, 'debug')])
+        self.assertEqual(builder.parse_variants(' 32 '), [(True, None)])
+        for spec in ('16', '64:fast', '64,64:debug', ''):
+            with self.assertRaises(Exception):
+                builder.parse_variants(spec)
+
+class BuildRootTest(unittest.TestCase):
+    def test_parse_build_root(self):
+        for root in (None, False, 'none', 'None'):
+            self.assertIsNone(builder.parse_build_root(root))
+
+        build_root = builder.parse_build_root('~/build')
+        self.assertEqual(build_root, {
+            'path': os.path.join(os.path.expanduser('~'), 'build'),
+            'min_free': 2 << 30,
+        })
+        build_root = builder.parse_build_root({'path': 'build',
+                                               'min_free': '512M'})
+        self.assertEqual(build_root, {
+            'path': os.path.join(os.getcwd(), 'build'),
+            'min_free': 512 << 20,
+        })
+
+    def test_desired_buildpath(self):
+        srcpath = '/work/repo/src/liba'
+        self.assertEqual(builder.desired_buildpath({}, srcpath, '/work/repo',
+                                                   False, None),
+                         ('/work/repo/src/liba/build', None))
+
+        build_root = builder.parse_build_root('/fast')
+        path, root = builder.desired_buildpath({}, srcpath, '/work/repo',
+                                               True, build_root)
+        self.assertEqual(root, build_root)
+        fast, repodir, name, build = path.strip('/').split('/')
+        self.assertEqual((fast, name, build), ('fast', 'liba', 'build32'))
+        self.assertTrue(repodir.startswith('repo-'))
+
+        # Repos sharing a build root get their own dirs in it
+        other, _ = builder.desired_buildpath({}, '/other/repo/src/liba',
+                                             '/other/repo', True, build_root)
+        self.assertNotEqual(path, other)
+
+        # Packages can override the build root of the repo
+        self.assertEqual(builder.desired_buildpath(
+                {'build_root': 'none'}, srcpath, '/work/repo', False,
+                build_root),
+            ('/work/repo/src/liba/build', None))
+        path, root = builder.desired_buildpath(
+                {'build_root': '/other'}, srcpath, '/work/repo', False, None)
+        self.assertEqual(root['path'], '/other')
+        self.assertTrue(path.startswith('/other/repo-'))
+
+class StateDBTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def open(self):
+        db = builder.StateDB(self.workdir)
+        self.addCleanup(db.close)
+        return db
+
+    def user_version(self):
+        db = sqlite3.connect(os.path.join(self.workdir, 'state.db'))
+        try:
+            return db.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            db.close()
+
+    def test_migrate_json(self):
+        pkgsdir = os.path.join(self.workdir, 'pkgs')
+        os.mkdir(pkgsdir)
+        with open(os.path.join(pkgsdir, 'liba.json'), 'w') as f:
+            json.dump({'name': 'liba', 'state': {
+                'configured': True, 'configure_options': 'meson',
+                'built': True, 'fingerprint': {'src': 'abc'}}}, f)
+        with open(os.path.join(pkgsdir, 'broken.json'), 'w') as f:
+            f.write('{')
+
+        run = {'time': 1000.0, 'wall': 12.5, 'packages': {
+            'liba': {'phases': {'build': {'wall': 10.0, 'cpu': 30.0,
+                                          'maxrss': 2048, 'calls': 1}},
+                     'ninja': [[1.5, 'liba.so']]}}}
+        with open(os.path.join(self.workdir, 'history.jsonl'), 'w') as f:
+            f.write(json.dumps(run) + '\n')
+            f.write('not json\n')
+
+        db = self.open()
+
+        state = db.load_state('liba', '64')
+        self.assertTrue(state['configured'])
+        self.assertEqual(state['configure_options'], 'meson')
+        self.assertTrue(state['built'])
+        # Installing was part of building
+        self.assertTrue(state['installed'])
+        self.assertEqual(state['fingerprint'], {'src': 'abc'})
+        self.assertIsNone(db.load_state('liba', '32'))
+        self.assertIsNone(db.load_state('broken', '64'))
+
+        self.assertEqual(db.runs(), [run])
+
+        self.assertFalse(os.path.exists(pkgsdir))
+        self.assertTrue(os.path.isdir(pkgsdir + '.migrated'))
+        self.assertTrue(os.path.exists(os.path.join(
+            self.workdir, 'history.jsonl.migrated')))
+        self.assertEqual(self.user_version(), builder.StateDB.SCHEMA_VERSION)
+
+        # Migrating again finds nothing left to import
+        db.close()
+        self.assertEqual(self.open().runs(), [run])
+
+    def test_upgrade_v1(self):
+        db = sqlite3.connect(os.path.join(self.workdir, 'state.db'))
+        db.executescript("""
+            CREATE TABLE state (
+                name TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                configured INTEGER NOT NULL DEFAULT 0,
+                configure_options TEXT,
+                autogen TEXT,
+                built INTEGER NOT NULL DEFAULT 0,
+                fingerprint TEXT,
+                artifact TEXT,
+                PRIMARY KEY (name, variant)
+            );
+            CREATE TABLE manifest (
+                name TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                path TEXT NOT NULL,
+                hash TEXT,
+                PRIMARY KEY (name, variant, path)
+            );
+            CREATE TABLE runs (
+                id INTEGER PRIMARY KEY,
+                time REAL NOT NULL,
+                wall REAL
+            );
+            CREATE TABLE timings (
+                run INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                wall REAL,
+                cpu REAL,
+                maxrss INTEGER,
+                calls INTEGER
+            );
+            CREATE TABLE ninja_targets (
+                run INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                target TEXT NOT NULL,
+                seconds REAL
+            );
+            INSERT INTO state (name, variant, configured, built)
+                VALUES ('liba', '64', 1, 1), ('libb', '64', 1, 0);
+            INSERT INTO runs VALUES (1, 1000.0, 5.0);
+            INSERT INTO timings VALUES (1, 'liba', 'build', 5.0, 9.0, 100, 2);
+            PRAGMA user_version = 1;
+        """)
+        db.close()
+
+        db = self.open()
+        self.assertEqual(self.user_version(), builder.StateDB.SCHEMA_VERSION)
+
+        liba = db.load_state('liba', '64')
+        self.assertTrue(liba['built'])
+        self.assertTrue(liba['installed'])
+        # Build dirs were next to the sources
+        self.assertIsNone(liba['buildpath'])
+        self.assertIsNone(liba['build_root'])
+        self.assertFalse(db.load_state('libb', '64')['installed'])
+
+        # Runs from before memory was sampled fall back to the largest
+        # process times the jobs
+        self.assertEqual(db.peak_memory('liba', 4), 100 * 1024 * 4)
+        self.assertEqual(db.peak_memory('libb', 4), 0)
+        db.set_unfinished([('libb', False, 'debug', 'build')])
+        self.assertEqual(db.unfinished(), [('libb', False, 'debug', 'build')])
+
+        db.add_run({'time': 2000.0, 'wall': 1.0, 'packages': {
+            'liba': {'phases': {}, 'memory': 1 << 20}}})
+        self.assertEqual(db.peak_memory('liba', 4), 1 << 20)
+
+    def test_peak_memory(self):
+        db = self.open()
+        for peak in (900, 100, 200, 300, 400, 500):
+            db.add_run({'time': 1000.0, 'wall': 1.0, 'packages': {
+                'liba': {'phases': {}, 'memory': peak}}})
+        # Only the recent runs count
+        self.assertEqual(db.peak_memory('liba', 4), 500)
+
+class PkgTest(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basedir)
+
+    # A Pkg of a git repo with one commit, with 'state' saved for it
+    def pkg(self, pkglist, name, state=None):
+        srcpath = os.path.join(self.basedir, 'src', name)
+        os.makedirs(srcpath)
+        with open(os.path.join(srcpath, 'README'), 'w') as f:
+            f.write(name)
+        env = dict(os.environ, GIT_AUTHOR_NAME='builder',
+                   GIT_AUTHOR_EMAIL='builder@example.com',
+                   GIT_COMMITTER_NAME='builder',
+                   GIT_COMMITTER_EMAIL='builder@example.com')
+        for cmd in (['git', 'init', '-q'], ['git', 'add', 'README'],
+                    ['git', 'commit', '-q', '-m', 'import']):
+            subprocess.check_call(cmd, cwd=srcpath, env=env)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            logger = builder.Logger(os.path.join(self.basedir, 'log.txt'))
+        self.addCleanup(logger.get_file().close)
+        db = builder.StateDB(self.basedir)
+        self.addCleanup(db.close)
+        if state is not None:
+            saved = dict((field, None)
+                         for field in builder.StateDB.STATE_FIELDS)
+            saved.update(state)
+            db.save_state(name, '64', saved)
+        return builder.Pkg(pkglist, name, self.basedir, logger, env, db=db)
+
+    def test_artifact_deps(self):
+        pkglist = {
+            'tests': {'skipinstall': True},
+            'liba': {},
+            'libb': {'deps': ['liba', 'libx']},
+            'app': {},
+        }
+        graph = {'tests': [], 'liba': ['tests'], 'libb': ['liba'],
+                 'app': ['tests', 'liba', 'libb']}
+        self.assertEqual(builder.artifact_deps('liba', graph, pkglist), [])
+        # Declared deps count even when they are not being built
+        self.assertEqual(builder.artifact_deps('libb', graph, pkglist),
+                         ['liba', 'libx'])
+        self.assertEqual(builder.artifact_deps('app', graph, pkglist),
+                         ['liba', 'libb'])
+
+    def test_cache_key(self):
+        pkg = self.pkg({'liba': {}}, 'liba')
+        pkg._deps_fingerprints = []
+        key = pkg._cache_key()
+        self.assertIsNotNone(key)
+
+        # Built against something else
+        pkg._deps_fingerprints = [{'head': 'abc'}]
+        self.assertNotIn(pkg._cache_key(), (None, key))
+
+        # A dependency that isn't installed can't be identified
+        pkg._deps_fingerprints = [None]
+        self.assertIsNone(pkg._cache_key())
+
+        # Nor uncommitted changes
+        pkg._deps_fingerprints = []
+        with open(os.path.join(pkg.srcpath, 'README'), 'a') as f:
+            f.write('changed')
+        pkg._fingerprint = None
+        self.assertIsNone(pkg._cache_key())
+
+    def test_options_changed(self):
+        buildpath = os.path.join(self.basedir, 'src', 'liba', 'build')
+        pkg = self.pkg({'liba': {'meson': '-Dfoo=true'}}, 'liba', {
+            'configured': True, 'buildpath': buildpath})
+        # Configured before the options were recorded
+        self.assertFalse(pkg._options_changed())
+
+        pkg._configured_digest = 'old'
+        self.assertTrue(pkg._options_changed())
+        pkg._configured_digest = pkg._configure_digest()
+        self.assertFalse(pkg._options_changed())
+
+class JobserverTest(unittest.TestCase):
+    def test_fixed_jobs(self):
+        jobserver = builder.Jobserver(4, {})
+        self.addCleanup(jobserver.close)
+
+        jobserver.acquire_build()
+        # Takes every free slot
+        self.assertEqual(jobserver.fixed_jobs(8), (3, 4))
+        jobserver.release(3)
+
+        # The other package holds the free slots, but this one still gets
+        # its share
+        jobserver.acquire_build()
+        held = jobserver.try_acquire(2)
+        self.assertEqual(jobserver.fixed_jobs(8), (0, 2))
+        jobserver.release(held)
+
+        # Never more than asked for
+        self.assertEqual(jobserver.fixed_jobs(1), (0, 1))
+
+class MemoryGovernorTest(unittest.TestCase):
+    def test_growth(self):
+        jobserver = builder.Jobserver(4, {})
+        self.addCleanup(jobserver.close)
+        governor = builder.MemoryGovernor(1 << 40, jobserver)
+        # Samples are given by hand instead
+        governor.close()
+
+        governor._update(1000)
+        governor.admit('liba', 0)
+        governor._update(1500)
+        governor.admit('libb', 300)
+        # libb is expected to take 300 of it
+        governor._update(2100)
+        governor._update(1800)
+        self.assertEqual(governor.done('liba'), 800)
+        self.assertEqual(governor.done('libb'), 600)
+
+        governor.admit('app', 0)
+        governor._update(1000)
+        self.assertEqual(governor.done('app'), 0)
+
+class SchedulerTest(unittest.TestCase):
+    def run_graph(self, graph, fail=(), jobs=1, stop=None, waits={}):
+        started = []
+
+        def func(name):
+            started.append(name)
+            if name in fail:
+                raise Exception('%s failed' % name)
+
+        scheduler = builder.Scheduler(graph, jobs, stop)
+        ok = scheduler.run(func, waits)
+        return scheduler, ok, started
+
+    def test_dependency_order(self):
+        graph = {'app': ['libb'], 'libb': ['liba'], 'liba': [], 'solo': []}
+        scheduler, ok, started = self.run_graph(graph, jobs=4)
+        self.assertTrue(ok)
+        self.assertEqual(sorted(scheduler.done), sorted(graph))
+        self.assertLess(started.index('liba'), started.index('libb'))
+        self.assertLess(started.index('libb'), started.index('app'))
+
+    def test_failure_blocks_dependents(self):
+        graph = {'liba': [], 'libb': ['liba'], 'app': ['libb'], 'solo': []}
+        scheduler, ok, started = self.run_graph(graph, fail={'liba'})
+        self.assertFalse(ok)
+        self.assertEqual(list(scheduler.failed), ['liba'])
+        self.assertEqual(sorted(scheduler.blocked), ['app', 'libb'])
+        # Packages not depending on the failure still get built
+        self.assertEqual(scheduler.done, ['solo'])
+        self.assertEqual(scheduler.stopped, [])
+        self.assertNotIn('libb', started)
+
+    def test_failure_with_stop(self):
+        graph = {'liba': [], 'libb': ['liba'], 'solo': []}
+        stop = threading.Event()
+        scheduler, ok, started = self.run_graph(graph, fail={'liba'},
+                                                stop=stop)
+        self.assertFalse(ok)
+        self.assertTrue(stop.is_set())
+        self.assertEqual(scheduler.blocked, ['libb'])
+        self.assertEqual(scheduler.stopped, ['solo'])
+        self.assertEqual(started, ['liba'])
+
+    def test_failed_wait(self):
+        graph = {'liba': [], 'libb': ['liba'], 'solo': []}
+        fetch = Future()
+        fetch.set_exception(Exception('fetch failed'))
+        stop = threading.Event()
+        scheduler, ok, started = self.run_graph(graph, stop=stop,
+                                                waits={'liba': fetch})
+        self.assertFalse(ok)
+        self.assertIn('liba', scheduler.failed)
+        self.assertEqual(scheduler.blocked, ['libb'])
+        # Failed fetches don't stop the other packages
+        self.assertFalse(stop.is_set())
+        self.assertEqual(scheduler.done, ['solo'])
+
+    def test_cycle(self):
+        with self.assertRaises(Exception):
+            builder.Scheduler({'liba': ['libb'], 'libb': ['liba']})
+
+if __name__ == '__main__':
+    unittest.main()